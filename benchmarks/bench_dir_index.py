@@ -0,0 +1,48 @@
+"""
+skip-if-exists check on a synthetic folder: Path.exists probes vs DirIndex
+
+    python benchmarks/bench_dir_index.py [files] [folder]
+
+pass a folder on the network volume to see the stat cost that matters.
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from redbook.helper import DirIndex
+
+SUFFIXES = ['.webp', '.jpg', '.heic', '.png', '.heif']
+
+
+def probe(img: Path) -> Path | None:
+    for suffix in SUFFIXES:
+        if (i := img.with_suffix(suffix)).exists():
+            return i
+
+
+def main(files: int = 50000, folder: str = None):
+    root = Path(folder or tempfile.mkdtemp())
+    for i in range(files):
+        (root / f'24-01-01_user_{i:024x}_1_img.jpg').touch()
+    # half hit on the 2nd suffix, half miss all five
+    queries = [root / f'24-01-01_user_{i:024x}_1_img.webp'
+               for i in range(0, files * 2, 2)]
+
+    start = time.perf_counter()
+    hits = sum(probe(q) is not None for q in queries)
+    cost_probe = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = DirIndex()
+    index_hits = sum(index.find(q, SUFFIXES) is not None for q in queries)
+    cost_index = time.perf_counter() - start
+    assert hits == index_hits
+
+    print(f'{files} files, {len(queries)} lookups, {hits} hits')
+    print(f'Path.exists probes {cost_probe:8.3f}s')
+    print(f'DirIndex           {cost_index:8.3f}s (scan included)')
+
+
+if __name__ == '__main__':
+    main(*[int(a) if a.isdigit() else a for a in sys.argv[1:]])
@@ -0,0 +1,69 @@
+"""
+how long images wait when a few large videos are queued in front of them:
+the old global Semaphore(10), DownloadScheduler with its default host
+queues, and DownloadScheduler with a total limit of 10 shared by all hosts.
+videos and images are spread over several cdn hosts.
+
+transfers are simulated with sleeps, the point is the queueing.
+
+    python benchmarks/bench_download_scheduler.py [videos] [images]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from redbook.download_scheduler import DownloadScheduler, priority
+
+VIDEOS = [(f'https://sns-video-{cdn}.xhscdn.com/v', 'n.mp4', 3.0)
+          for cdn in ['bd', 'hw', 'qc']]
+IMAGES = [(f'https://sns-img-{cdn}.xhscdn.com/i', 'n_1_img.webp', 0.1)
+          for cdn in ['hw', 'qc']]
+
+
+async def with_semaphore(jobs):
+    semaphore = asyncio.Semaphore(10)
+
+    async def download(url, filename, seconds):
+        async with semaphore:
+            await asyncio.sleep(seconds)
+    return await run(jobs, download)
+
+
+async def with_scheduler(jobs, total=None):
+    scheduler = DownloadScheduler(total=total)
+
+    async def download(url, filename, seconds):
+        async with scheduler.slot(url, priority(url, filename)):
+            await asyncio.sleep(seconds)
+    return await run(jobs, download)
+
+
+async def run(jobs, download):
+    start = time.perf_counter()
+    done = {}
+
+    async def timed(job):
+        await download(*job)
+        done.setdefault(job[1], []).append(time.perf_counter() - start)
+    await asyncio.gather(*map(timed, jobs))
+    return done, time.perf_counter() - start
+
+
+async def main(videos: int = 12, images: int = 120):
+    jobs = ([VIDEOS[i % 3] for i in range(videos)] +
+            [IMAGES[i % 2] for i in range(images)])
+    strategies = [
+        ('Semaphore(10)', with_semaphore),
+        ('DownloadScheduler', with_scheduler),
+        ('total limit 10', lambda jobs: with_scheduler(jobs, 10)),
+    ]
+    for name, strategy in strategies:
+        done, total = await strategy(jobs)
+        imgs = done[IMAGES[0][1]]
+        print(f'{name:<18} images done: mean {statistics.mean(imgs):5.2f}s '
+              f'last {max(imgs):5.2f}s   all done {total:5.2f}s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,39 @@
+"""
+microbenchmarks of native_sign, parity with the bundle is checked by
+tests/test_native_sign.py
+
+    python benchmarks/bench_native_sign.py
+"""
+import time
+
+from redbook.client_v2 import native_sign
+
+A1 = '1908d1a0b6eb13b5egsm8ggm97q17yfuv92n4l0g850000266761'
+API = '/api/sns/web/v1/feed'
+DATA = {'source_note_id': '68f88251000000000301d972',
+        'image_formats': ['jpg', 'webp', 'avif'],
+        'extra': {'need_body_topic': 1},
+        'xsec_token': 'ABfuVL1abrca5AtSMfNR0pWGBkZh387i3pykPOCHh4QbA=',
+        'xsec_source': 'pc_user'}
+XT = 1700000000000
+
+
+def timeit(name: str, rounds: int, func, *args) -> None:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(*args)
+    cost = (time.perf_counter() - start) / rounds
+    print(f'{name:<16} {cost * 1e6:10.2f} µs/op')
+
+
+def bench(rounds: int = 10000):
+    xs = native_sign.x_s('mns0201_' + 'x' * 200)
+    timeit('mnsv2_args', rounds, native_sign.mnsv2_args, API, DATA)
+    timeit('x_s', rounds, native_sign.x_s, 'mns0201_' + 'x' * 200)
+    timeit('x_s_common', rounds, native_sign.x_s_common, A1, xs, XT)
+    timeit('xray_traceid', rounds, native_sign.xray_traceid)
+    timeit('b3_traceid', rounds, native_sign.b3_traceid)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,311 @@
+"""
+offline parser benchmarks on recorded payloads
+
+    python benchmarks/bench_parser.py export [notes] [users]  # db + network
+    python benchmarks/bench_parser.py baseline                # store baseline
+    python benchmarks/bench_parser.py [tolerance]             # compare
+
+export samples Cache.note_info and get_user(parse=False) responses,
+anonymizes them and writes them gzipped to benchmarks/fixtures. Keys the
+parser does not read are dropped. Ids and tokens are scrambled with a salt
+that is thrown away, keeping their length and alphabet so the parser sees
+the same shapes; names and locations become pseudonyms and texts are
+masked.
+
+every operation is timed on the whole corpus, best of ROUNDS. A digest of
+its results is kept with the timings: a run fails when any result differs
+from the baseline or an operation got slower than tolerance (default 25%).
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import string
+import sys
+import time
+from copy import deepcopy
+from pathlib import Path
+
+from peewee import fn
+
+from redbook.exception import UserNotFoundError
+from redbook.helper import normalize_count
+from redbook.model import Cache, Note, User
+from redbook.redbook import _parse_user, get_user, parse_note
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+NOTES = FIXTURES / 'notes.json.gz'
+USERS = FIXTURES / 'users.json.gz'
+BASELINE = FIXTURES / 'parser_baseline.json'
+ROUNDS = 5
+MIN_ROUND = 0.2  # seconds
+SALT = os.urandom(16)
+# what parse_note and _parse_user read, by where it sits in the payload
+NOTE_KEYS = {
+    'note_id', 'xsec_token', 'url', 'type', 'title', 'desc', 'time',
+    'last_update_time', 'ip_location', 'user', 'share_info',
+    'interact_info', 'tag_list', 'at_user_list', 'image_list', 'video',
+    'audio_info'}
+NOTE_USER_KEYS = {'user_id', 'nickname', 'avatar', 'xsec_token'}
+SHARE_KEYS = {'un_share'}
+TAG_KEYS = {'name', 'type'}
+AT_USER_KEYS = {'user_id', 'nickname', 'xsec_token'}
+IMAGE_KEYS = {'info_list', 'url_default', 'url_pre', 'file_id', 'url',
+              'live_photo', 'stream', 'height', 'width'}
+STREAM_KEYS = {'height', 'avg_bitrate', 'master_url'}
+USER_KEYS = {'id', 'homepage', 'basic_info', 'extra_info', 'interactions',
+             'tags', 'tab_public', 'verify_info'}
+BASIC_KEYS = {'red_id', 'nickname', 'desc', 'imageb', 'images', 'gender',
+              'ip_location'}
+EXTRA_KEYS = {'fstatus', 'blockType'}
+
+
+def scramble(value: str) -> str:
+    """same length and character classes, not reversible without SALT"""
+    rng = random.Random(hashlib.sha256(SALT + value.encode()).digest())
+    is_hex = re.fullmatch(r'[0-9a-f]+', value) is not None
+    out = []
+    for c in value:
+        if is_hex:
+            c = rng.choice(string.hexdigits[:16])
+        elif c.isdigit():
+            c = rng.choice(string.digits)
+        elif c in string.ascii_lowercase:
+            c = rng.choice(string.ascii_lowercase)
+        elif c in string.ascii_uppercase:
+            c = rng.choice(string.ascii_uppercase)
+        out.append(c)
+    return ''.join(out)
+
+
+def pseudonym(name: str) -> str:
+    """stands for the same name everywhere, distinct names stay distinct"""
+    return hashlib.sha256(SALT + name.encode()).hexdigest()[:len(name) + 4]
+
+
+def blank(text: str) -> str:
+    """text with its whitespace and markup kept, the words gone"""
+    return re.sub(r'[^\s\x0b#@\[\]]', 'x', text)
+
+
+def keep(payload: dict, keys: set[str]) -> dict:
+    return {k: v for k, v in payload.items() if k in keys}
+
+
+def strip_note(note: dict) -> dict:
+    note = keep(note, NOTE_KEYS)
+    note['user'] = keep(note['user'], NOTE_USER_KEYS)
+    note['share_info'] = keep(note['share_info'], SHARE_KEYS)
+    note['tag_list'] = [keep(t, TAG_KEYS) for t in note['tag_list']]
+    note['at_user_list'] = [keep(a, AT_USER_KEYS)
+                            for a in note['at_user_list']]
+    note['image_list'] = [keep(i, IMAGE_KEYS) for i in note['image_list']]
+    for image in note['image_list']:
+        if stream := image.get('stream'):
+            image['stream'] = {k: [keep(s, STREAM_KEYS) for s in v]
+                               for k, v in stream.items()}
+    if video := note.get('video'):
+        stream = video['media']['stream']
+        note['video'] = {'media': {'stream': {
+            k: [keep(s, STREAM_KEYS) for s in v] for k, v in stream.items()}}}
+    return note
+
+
+def strip_user(user_info: dict) -> dict:
+    user_info = keep(user_info, USER_KEYS)
+    user_info['basic_info'] = keep(user_info['basic_info'], BASIC_KEYS)
+    user_info['extra_info'] = keep(user_info['extra_info'], EXTRA_KEYS)
+    user_info['interactions'] = [keep(i, {'type', 'count'})
+                                 for i in user_info['interactions']]
+    user_info['tags'] = [keep(t, {'tagType', 'name'})
+                         for t in user_info['tags']]
+    user_info['tab_public'] = keep(user_info['tab_public'], {'collection'})
+    return user_info
+
+
+def replace_all(payload, secrets: dict[str, str]):
+    """
+    replace the secrets in every string value, inside urls too; short ones
+    would hit unrelated text and are left to the callers
+    """
+    secrets = {k: v for k, v in secrets.items() if len(k) >= 8}
+    if not secrets:
+        return payload
+    pattern = re.compile('|'.join(
+        map(re.escape, sorted(secrets, key=len, reverse=True))))
+
+    def walk(value):
+        if isinstance(value, str):
+            return pattern.sub(lambda m: secrets[m.group()], value)
+        if isinstance(value, dict):
+            return {k: walk(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return list(map(walk, value))
+        return value
+    return walk(payload)
+
+
+def anonymize_note(note: dict) -> dict:
+    note = strip_note(note)
+    user = note['user']
+    values = [note['note_id'], note['xsec_token'], user['user_id'],
+              user.get('xsec_token'),
+              user['avatar'].split('?')[0].rsplit('/', 1)[-1],
+              *parse_note(note)['pic_ids']]
+    for a in note['at_user_list']:
+        values += [a['user_id'], a.get('xsec_token')]
+    note = replace_all(note, {v: scramble(v) for v in values if v})
+    note['user']['nickname'] = pseudonym(note['user']['nickname'])
+    if note.get('ip_location'):
+        note['ip_location'] = pseudonym(note['ip_location'])
+    for key in ['title', 'desc']:
+        if note.get(key):
+            note[key] = blank(note[key])
+    for a in note['at_user_list']:
+        a['nickname'] = pseudonym(a['nickname'])
+    for tag in note['tag_list']:
+        tag['name'] = pseudonym(tag['name'])
+    return note
+
+
+def anonymize_user(user_info: dict) -> dict:
+    user_info = strip_user(user_info)
+    basic = user_info['basic_info']
+    red_id = scramble(basic['red_id'])
+    secrets = {user_info['id']: scramble(user_info['id'])}
+    for key in ['imageb', 'images']:
+        avatar_id = basic[key].split('?')[0].rsplit('/', 1)[-1]
+        secrets[avatar_id] = scramble(avatar_id)
+    user_info = replace_all(user_info, secrets)
+    basic = user_info['basic_info']
+    basic['red_id'] = red_id
+    basic['nickname'] = pseudonym(basic['nickname'])
+    basic['desc'] = blank(basic['desc'])
+    if basic.get('ip_location'):
+        basic['ip_location'] = pseudonym(basic['ip_location'])
+    for tag in user_info['tags']:
+        if tag.get('name'):
+            tag['name'] = pseudonym(tag['name'])
+    return user_info
+
+
+def dump(path: Path, payloads: list[dict]):
+    FIXTURES.mkdir(exist_ok=True)
+    with gzip.open(path, 'wt') as f:
+        json.dump(payloads, f, ensure_ascii=False)
+
+
+def load(path: Path) -> list[dict]:
+    if not path.exists():
+        sys.exit(f'{path} not found, run export first')
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+
+async def export(notes: int = 2000, users: int = 100):
+    query = Cache.select().order_by(fn.Random()).limit(notes)
+    dump(NOTES, [anonymize_note(c.note_info) for c in query])
+    print(f'{len(query)} notes exported to {NOTES}')
+    user_infos = []
+    for user in User.select(User.id).order_by(fn.Random()).limit(users):
+        try:
+            user_info = await get_user(user.id, parse=False)
+        except UserNotFoundError:
+            continue
+        user_infos.append(anonymize_user(user_info))
+    dump(USERS, user_infos)
+    print(f'{len(user_infos)} users exported to {USERS}')
+
+
+def to_note(note_dict: dict) -> Note:
+    note = Note(**note_dict)
+    note.username = note_dict['nickname']
+    return note
+
+
+def operations(notes: list[dict], users: list[dict]) -> dict:
+    """name -> (operation run on a corpus, makes the corpus, its size)"""
+    counts = [v for n in notes for k, v in n['interact_info'].items()
+              if 'count' in k]
+    models = [to_note(parse_note(n)) for n in notes]
+    filepath = Path('/bench')
+    return {
+        'parse_note': (
+            lambda c: [parse_note(n) for n in c], lambda: notes, len(notes)),
+        'parse_note(strict)': (
+            lambda c: [parse_note(n, strict=True) for n in c],
+            lambda: notes, len(notes)),
+        # _parse_user consumes its input, copies are made before timing
+        '_parse_user': (lambda c: [_parse_user(u) for u in c],
+                        lambda: deepcopy(users), len(users)),
+        'normalize_count': (lambda c: [normalize_count(n) for n in c],
+                            lambda: counts, len(counts)),
+        'Note.medias': (lambda c: [list(m.medias(filepath)) for m in c],
+                        lambda: models, len(models)),
+        'Note.gen_meta': (lambda c: [m.gen_meta(url=m.url) for m in c],
+                          lambda: models, len(models)),
+    }
+
+
+def digest(results) -> str:
+    def default(o):
+        return o.timestamp() if hasattr(o, 'timestamp') else str(o)
+    text = json.dumps(results, default=default, ensure_ascii=False)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def measure() -> dict:
+    notes, users = load(NOTES), load(USERS)
+    report = {}
+    for name, (func, corpus, size) in operations(notes, users).items():
+        start = time.perf_counter()
+        results = func(corpus())
+        # small corpora are run several times per round
+        number = math.ceil(MIN_ROUND / (time.perf_counter() - start))
+        best = float('inf')
+        for _ in range(ROUNDS):
+            corpora = [corpus() for _ in range(number)]
+            start = time.perf_counter()
+            for c in corpora:
+                func(c)
+            best = min(best, (time.perf_counter() - start) / number)
+        report[name] = {'corpus': best, 'per_op': best / max(size, 1),
+                        'size': size, 'digest': digest(results)}
+        print(f'{name:<20} {size:6d} items  {best * 1e3:9.2f}ms  '
+              f'{best / max(size, 1) * 1e6:9.2f}us/op')
+    return report
+
+
+def compare(tolerance: float = 0.25):
+    if not BASELINE.exists():
+        sys.exit(f'{BASELINE} not found, run baseline first')
+    baseline = json.loads(BASELINE.read_text())
+    report = measure()
+    failures = []
+    for name, current in report.items():
+        if not (base := baseline.get(name)):
+            continue
+        if current['digest'] != base['digest']:
+            failures.append(f'{name}: results differ from the baseline')
+        ratio = current['per_op'] / base['per_op']
+        print(f'{name:<20} {ratio:6.2f}x baseline')
+        if ratio > 1 + tolerance:
+            failures.append(f'{name}: {ratio:.2f}x slower than the baseline')
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    match sys.argv[1:2]:
+        case ['export']:
+            asyncio.run(export(*map(int, sys.argv[2:])))
+        case ['baseline']:
+            BASELINE.write_text(json.dumps(measure(), indent=1))
+            print(f'baseline written to {BASELINE}')
+        case _:
+            compare(*map(float, sys.argv[1:]))
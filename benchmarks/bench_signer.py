@@ -0,0 +1,47 @@
+"""
+signatures per second: execjs (one node per call) vs the warm signer pool
+
+    python benchmarks/bench_signer.py [rounds]
+"""
+import sys
+import time
+
+import execjs
+
+from redbook.client_v2.signer import STATIC_PATH, SignerPool
+
+A1 = '1908d1a0b6eb13b5egsm8ggm97q17yfuv92n4l0g850000266761'
+API = '/api/sns/web/v1/feed'
+DATA = {'source_note_id': '68f88251000000000301d972',
+        'image_formats': ['jpg', 'webp', 'avif'],
+        'extra': {'need_body_topic': 1},
+        'xsec_token': 'ABfuVL1abrca5AtSMfNR0pWGBkZh387i3pykPOCHh4QbA=',
+        'xsec_source': 'pc_user'}
+ARGS = (API, DATA, A1, 'POST')
+
+
+def timeit(name: str, rounds: int, func) -> None:
+    start = time.perf_counter()
+    func()
+    cost = time.perf_counter() - start
+    print(f'{name:<24} {rounds / cost:10.1f} sign/s  '
+          f'{cost / rounds * 1000:8.2f} ms/sign')
+
+
+def main(rounds: int = 50):
+    ctx = execjs.compile((STATIC_PATH / 'xhs_xs_xsc_56.js').read_text())
+    timeit('execjs', rounds, lambda: [
+        ctx.call('get_request_headers_params', *ARGS) for _ in range(rounds)])
+
+    pool = SignerPool('xhs_xs_xsc_56.js')
+    pool.call('get_request_headers_params', *ARGS)  # warm up
+    timeit('signer', rounds, lambda: [
+        pool.call('get_request_headers_params', *ARGS) for _ in range(rounds)])
+    timeit('signer (batch of 10)', rounds, lambda: [
+        pool.call_many([('get_request_headers_params', ARGS)] * 10)
+        for _ in range(rounds // 10)])
+    pool.close()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
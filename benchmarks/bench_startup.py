@@ -0,0 +1,58 @@
+"""
+cold start of the redbook cli: wall time of ``redbook <command> --help``
+per command, and the modules that cost most to import
+
+every run is a fresh interpreter, so nothing is warm but the os file cache.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = ['', 'note', 'user-loop', 'schedule', 'user', 'write-meta',
+            'clean-database']
+ENTRY = 'import sys; from redbook.script import app; sys.exit(app())'
+
+
+def run(*args: str) -> tuple[float, str]:
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, *args], capture_output=True,
+                          text=True, check=True)
+    return time.perf_counter() - start, proc.stderr
+
+
+def cold_start(command: str, runs: int) -> list[float]:
+    args = ['-c', ENTRY, *command.split(), '--help']
+    return [run(*args)[0] for _ in range(runs)]
+
+
+def import_cost(top: int = 12) -> list[tuple[int, str]]:
+    """cumulative import time (us) of the costliest modules"""
+    _, stderr = run('-X', 'importtime', '-c', 'import redbook.script')
+    costs = []
+    for line in stderr.splitlines():
+        if m := re.match(r'import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)', line):
+            cumulative, indent, module = m.groups()
+            # skip the modules nested deeper than redbook's own imports
+            if len(indent) <= 3:
+                costs.append((int(cumulative), f'{indent}{module}'))
+    return sorted(costs, reverse=True)[:top]
+
+
+def main(runs: int = 5):
+    run('-c', 'import redbook.script')  # warm the os file cache and pycs
+    for command in COMMANDS:
+        times = cold_start(command, runs)
+        print(f'redbook {command or "":<16} --help  '
+              f'median {statistics.median(times):5.2f}s  '
+              f'min {min(times):5.2f}s')
+    print('\nimport redbook.script, cumulative:')
+    for cumulative, module in import_cost():
+        print(f'{cumulative / 1e6:7.3f}s  {module}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,108 @@
+"""
+TLS handshakes per user_loop-like run against a local HTTPS stand-in: a
+fresh AsyncClient per round vs the shared pooled transport
+
+    python benchmarks/bench_transport.py [rounds] [requests_per_round]
+
+the stand-in uses a throwaway self-signed certificate made with openssl
+"""
+import asyncio
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from redbook.transport import API_LIMITS, PooledTransport
+
+RESPONSE = (b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+            b'Content-Type: application/json\r\n\r\n{}')
+
+
+class StandInServer:
+    def __init__(self) -> None:
+        self.connections = 0
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                writer.write(RESPONSE)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def run(make_client, refresh, url: str, rounds: int, requests: int):
+    client = None
+    for r in range(rounds):
+        client = await refresh(client, make_client, {'a1': f'round{r}'})
+        for _ in range(requests):
+            (await client.get(url)).raise_for_status()
+    await client.aclose()
+
+
+async def renew_each_round(client, make_client, cookies):
+    if client:
+        await client.aclose()
+    return make_client(cookies)
+
+
+async def refresh_in_place(client, make_client, cookies):
+    if client is None:
+        return make_client(cookies)
+    client.cookies.clear()
+    client.cookies.update(cookies)
+    return client
+
+
+def tls_contexts(workdir: Path) -> tuple[ssl.SSLContext, ssl.SSLContext]:
+    """server and client contexts for a self-signed localhost certificate"""
+    cert, key = workdir / 'cert.pem', workdir / 'key.pem'
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-days', '1', '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost',
+         '-keyout', str(key), '-out', str(cert)],
+        check=True, capture_output=True)
+    server = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server.load_cert_chain(cert, key)
+    server.set_alpn_protocols(['http/1.1'])
+    client = ssl.create_default_context(cafile=cert)
+    return server, client
+
+
+async def main(rounds: int = 20, requests: int = 30):
+    with tempfile.TemporaryDirectory() as workdir:
+        server_ctx, client_ctx = tls_contexts(Path(workdir))
+    for name, make_client, refresh in [
+        ('new client per round',
+         lambda c: httpx.AsyncClient(cookies=c, verify=client_ctx),
+         renew_each_round),
+        ('pooled transport',
+         lambda c: httpx.AsyncClient(cookies=c, transport=transport),
+         refresh_in_place),
+    ]:
+        transport = PooledTransport(API_LIMITS, verify=client_ctx)
+        stand_in = StandInServer()
+        server = await asyncio.start_server(
+            stand_in.handle, '127.0.0.1', 0, ssl=server_ctx)
+        port = server.sockets[0].getsockname()[1]
+        start = time.perf_counter()
+        await run(make_client, refresh,
+                  f'https://localhost:{port}/api', rounds, requests)
+        cost = time.perf_counter() - start
+        server.close()
+        await transport.shutdown()
+        print(f'{name:<22} {stand_in.connections:4d} connections '
+              f'for {rounds * requests} requests  {cost:6.2f}s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,102 @@
+"""
+UserConfig.update_table at 1k/10k configs: the old per-row loop vs the
+set-based version, in wall time and queries sent
+
+    python benchmarks/bench_update_table.py [database] [configs ...]
+
+tables are created in a scratch database (default redbook_bench) and
+dropped afterwards, the real redbook and photosinfo data is not touched.
+"""
+import sys
+import time
+
+import pendulum
+from photosinfo.model import Girl
+from toolkit.model import get_database
+
+from redbook.model import Note, User, UserConfig
+
+NOTES_PER_USER = 10
+MODELS = [User, UserConfig, Note, Girl]
+
+
+def update_table_per_row():
+    """
+    update_table as it was, one lookup and one save per row
+
+    the COUNT of recent notes is left out: post statistics now come from
+    record_post in both versions, so only photos_num and folder are compared
+    """
+    for config in UserConfig.select():
+        if girl := Girl.get_or_none(red_id=config.user_id):
+            config.photos_num = girl.red_num
+            config.folder = girl.folder
+        else:
+            config.photos_num = 0
+        config.save()
+
+
+def populate(configs: int):
+    now = pendulum.now()
+    users, notes = [], []
+    for i in range(configs):
+        uid = f'{i:024x}'
+        users.append(dict(
+            id=uid, red_id=f'red{i}', username=f'user{i}', nickname=f'n{i}',
+            homepage='', short_url='', following=True, gender=0, follows=0,
+            fans=0, interaction=0, verified=False, collection_public=False,
+            avatar=''))
+        for j in range(NOTES_PER_USER):
+            t = now.subtract(days=j * 5)
+            notes.append(dict(
+                id=f'{uid[-12:]}{j:012x}', user=uid, username=f'user{i}',
+                following=True, time=t, last_update_time=t, url='',
+                liked=False, collected=False, type='normal',
+                pic_ids=[], pics=[]))
+    User.insert_many(users).execute()
+    UserConfig.insert_many(
+        [dict(user=u['id'], red_id=u['red_id'], username=u['username'],
+              following=True, homepage='', note_fetch_at=now)
+         for u in users]).execute()
+    Girl.insert_many(
+        [dict(username=u['username'], red_id=u['id'], red_num=3,
+              folder='f') for u in users[::2]]).execute()
+    for i in range(0, len(notes), 1000):
+        Note.insert_many(notes[i:i+1000]).execute()
+
+
+def measure(db, func) -> tuple[float, int]:
+    queries = 0
+    execute_sql = db.execute_sql
+
+    def counted(*args, **kwargs):
+        nonlocal queries
+        queries += 1
+        return execute_sql(*args, **kwargs)
+    db.execute_sql = counted
+    start = time.perf_counter()
+    try:
+        func()
+    finally:
+        db.execute_sql = execute_sql
+    return time.perf_counter() - start, queries
+
+
+def main(name: str = 'redbook_bench', *sizes: int):
+    db = get_database(name)
+    with db.bind_ctx(MODELS):
+        for configs in sizes or (1000, 10000):
+            db.create_tables(MODELS)
+            try:
+                populate(configs)
+                for label, func in [('per row', update_table_per_row),
+                                    ('set based', UserConfig.update_table)]:
+                    cost, queries = measure(db, func)
+                    print(f'{configs:6d} configs  {label:<10} '
+                          f'{cost:7.2f}s {queries:7d} queries')
+            finally:
+                db.drop_tables(MODELS)
+
+
+if __name__ == '__main__':
+    main(*[int(a) if a.isdigit() else a for a in sys.argv[1:]])
@@ -0,0 +1,115 @@
+"""
+Python port of the deterministic parts of xhs_xs_xsc_56.js and xhs_xray.js
+
+x-s-common, the x-s envelope, x-xray-traceid and x-b3-traceid are computed
+here. Only ``mnsv2`` (the obfuscated VM inside x-s) still has to come from
+the signing bundle, so it is the single call left for the node worker.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import random
+import re
+import time
+import zlib
+from pathlib import Path
+
+STATIC_PATH = Path(__file__).parent / 'static'
+XS_BUNDLE = 'xhs_xs_xsc_56.js'
+
+_STD_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+_XHS_CHARS = b'ZmserbBoHQtNP+wOcza/LpngG8yJq42KWYj0DSfdikx3VT16IlUAFM97hECvuRX5'
+_B64_TABLE = bytes.maketrans(_STD_CHARS, _XHS_CHARS)
+
+FFF = re.search(r'var fff = "(.+?)";',
+                (STATIC_PATH / XS_BUNDLE).read_text()).group(1)
+CRC_KEY = 0xedb88320
+MAX_SEQ = 2 ** 23 - 1
+# next() on a count is atomic, so threads signing side by side never share
+# a sequence number
+_xray_seq = itertools.count(random.getrandbits(23))
+
+
+def b64_encode(data: bytes) -> str:
+    """base64 with the shuffled alphabet of ``b64Encode(encodeUtf8(s))``"""
+    return base64.b64encode(data).translate(_B64_TABLE).decode()
+
+
+def md5(s: str) -> str:
+    return hashlib.md5(s.encode()).hexdigest()
+
+
+def gens9(data: bytes) -> int:
+    """``-1 ^ crc ^ 0xedb88320`` as the signed int32 node would print"""
+    v = zlib.crc32(data) ^ CRC_KEY
+    return v - (1 << 32) if v & 0x80000000 else v
+
+
+def to_json(obj) -> str:
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def payload(api: str, data) -> str:
+    """the string ``seccore_signv2`` feeds to mnsv2"""
+    if isinstance(data, str) and data.strip():
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return api + data
+    if isinstance(data, (dict, list)):
+        return api + to_json(data)
+    if isinstance(data, str):
+        return api + data
+    return api
+
+
+def mnsv2_args(api: str, data) -> list[str]:
+    full = payload(api, data)
+    return [full, md5(full), md5(api)]
+
+
+def x_s(mns: str) -> str:
+    sign = {'x0': '4.3.2', 'x1': 'xhs-pc-web',
+            'x2': 'Windows', 'x3': mns, 'x4': 'object'}
+    return 'XYS_' + b64_encode(to_json(sign).encode())
+
+
+def x_s_common(a1: str, xs: str, xt: int) -> str:
+    d = {
+        's0': 5,
+        's1': '',
+        'x0': '1',
+        'x1': '4.3.2',
+        'x2': 'Windows',
+        'x3': 'xhs-pc-web',
+        'x4': '4.84.1',
+        'x5': a1,
+        'x6': xt,
+        'x7': xs,
+        'x8': FFF,
+        'x9': gens9(hashlib.md5(f'{xt}{xs}{FFF}'.encode()).digest()),
+        'x10': 0,
+        'x11': 'normal',
+    }
+    return b64_encode(to_json(d).encode())
+
+
+def xray_traceid(ts: int = None) -> str:
+    if ts is None:
+        ts = int(time.time() * 1000)
+    seq = next(_xray_seq) & MAX_SEQ
+    head = ((ts << 23) | seq) & 0xffffffffffffffff
+    return f'{head:016x}{random.getrandbits(64):016x}'
+
+
+def b3_traceid(length: int = 16) -> str:
+    return ''.join(random.choices('abcdef0123456789', k=length))
+
+
+def sign(signer, api: str, data, a1: str) -> tuple[str, int, str]:
+    """x-s, x-t and x-s-common; ``signer`` only has to answer ``mnsv2``"""
+    mns = signer.call('mnsv2', *mnsv2_args(api, data))
+    xs = x_s(mns)
+    xt = int(time.time() * 1000)
+    return xs, xt, x_s_common(a1, xs, xt)
@@ -0,0 +1,148 @@
+"""
+Long-lived node processes for the signing bundles
+
+execjs starts a fresh ``node`` and re-evaluates the whole bundle on every
+call, a worker here loads the bundle once and answers line-delimited JSON
+requests over stdin/stdout until it is closed.
+"""
+import atexit
+import itertools
+import json
+import queue
+import select
+import subprocess
+import threading
+from pathlib import Path
+
+from redbook import console
+from redbook.exception import SignerError
+
+STATIC_PATH = Path(__file__).parent / 'static'
+WORKER_JS = STATIC_PATH / 'signer_worker.js'
+# seconds to wait for the bundle to load and for each response
+START_TIMEOUT = 30
+CALL_TIMEOUT = 10
+
+
+class SignerWorker:
+    def __init__(self, bundle: str) -> None:
+        self.bundle = bundle
+        self.restarts = 0
+        self._started = False
+        self._proc: subprocess.Popen = None
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _spawn(self) -> None:
+        if self._started:
+            self.restarts += 1
+            console.log(f'restarting signer worker for {self.bundle}...',
+                        style='error')
+        self._started = True
+        self._proc = subprocess.Popen(
+            ['node', str(WORKER_JS), self.bundle],
+            cwd=Path(__file__).parent,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True, encoding='utf-8', bufsize=1)
+        try:
+            line = self._readline(START_TIMEOUT)
+        except TimeoutError:
+            line = ''
+        if not line or not json.loads(line).get('ready'):
+            self._kill()
+            raise SignerError(f'signer worker for {self.bundle} failed to start')
+
+    def _readline(self, timeout: float) -> str:
+        """
+        one line from the worker, TimeoutError if none arrives in time
+
+        the worker answers each request with exactly one line, so nothing
+        is left in the read buffer between requests and select on the
+        pipe is enough
+        """
+        ready, _, _ = select.select([self._proc.stdout], [], [], timeout)
+        if not ready:
+            raise TimeoutError(
+                f'signer worker for {self.bundle} did not answer '
+                f'within {timeout}s')
+        return self._proc.stdout.readline()
+
+    def _kill(self) -> None:
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._proc = None
+
+    def _roundtrip(self, calls: list) -> dict:
+        if self._proc is None or self._proc.poll() is not None:
+            self._spawn()
+        req_id = next(self._seq)
+        line = json.dumps({'id': req_id, 'calls': calls}, ensure_ascii=False)
+        self._proc.stdin.write(line + '\n')
+        self._proc.stdin.flush()
+        if not (resp := self._readline(CALL_TIMEOUT)):
+            raise BrokenPipeError('signer worker exited')
+        resp = json.loads(resp)
+        assert resp['id'] == req_id, (resp['id'], req_id)
+        return resp
+
+    def call_many(self, calls: list[tuple[str, list]]) -> list:
+        """run a batch of ``(function, args)`` in one round trip"""
+        calls = [[fn, list(args)] for fn, args in calls]
+        with self._lock:
+            try:
+                resp = self._roundtrip(calls)
+            except (OSError, ValueError) as e:
+                # TimeoutError is an OSError too: a hung worker is killed
+                # and respawned like a crashed one
+                console.log(f'signer worker for {self.bundle} failed: {e!r}',
+                            style='error')
+                self._kill()
+                resp = self._roundtrip(calls)
+        if 'error' in resp:
+            raise SignerError(resp['error'])
+        return resp['results']
+
+    def call(self, fn: str, *args):
+        return self.call_many([(fn, args)])[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.stdin.close()
+            self._kill()
+
+
+class SignerPool:
+    """a small pool of warm workers sharing one bundle"""
+
+    def __init__(self, bundle: str, size: int = 1) -> None:
+        self.bundle = bundle
+        self.size = size
+        self._workers = [SignerWorker(bundle) for _ in range(size)]
+        self._idle = queue.LifoQueue()  # keep reusing the warmest worker
+        for worker in self._workers:
+            self._idle.put(worker)
+        atexit.register(self.close)
+
+    def call_many(self, calls: list[tuple[str, list]]) -> list:
+        worker = self._idle.get()
+        try:
+            return worker.call_many(calls)
+        finally:
+            self._idle.put(worker)
+
+    def call(self, fn: str, *args):
+        return self.call_many([(fn, args)])[0]
+
+    @property
+    def restarts(self) -> int:
+        return sum(w.restarts for w in self._workers)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.close()
@@ -0,0 +1,61 @@
+/**
+ * 常驻签名进程
+ * 用法: node signer_worker.js <bundle.js>
+ *
+ * 每行一个 JSON 请求: {"id": 1, "calls": [["fn", [arg1, arg2]], ...]}
+ * 每行一个 JSON 响应: {"id": 1, "results": [...]} 或 {"id": 1, "error": "..."}
+ * 加载完成后输出 {"ready": true}
+ */
+var path = require("path");
+var readline = require("readline");
+
+// 签名脚本会往 stdout 打日志，统一改到 stderr，stdout 只留给协议
+var write = process.stdout.write.bind(process.stdout);
+var log = function () {
+    process.stderr.write(Array.prototype.join.call(arguments, " ") + "\n");
+};
+console.log = console.info = console.debug = console.warn = log;
+
+var bundle = require(path.resolve(__dirname, process.argv[2]));
+
+function lookup(name) {
+    var fn = bundle && bundle[name];
+    if (typeof fn !== "function") {
+        fn = global[name];
+    }
+    if (typeof fn !== "function") {
+        throw new Error("function not found: " + name);
+    }
+    return fn;
+}
+
+function send(obj) {
+    write(JSON.stringify(obj) + "\n");
+}
+
+var rl = readline.createInterface({input: process.stdin, terminal: false});
+rl.on("line", function (line) {
+    if (!line.trim()) {
+        return;
+    }
+    var req;
+    try {
+        req = JSON.parse(line);
+    } catch (e) {
+        send({id: null, error: "invalid request: " + e.message});
+        return;
+    }
+    try {
+        var results = req.calls.map(function (call) {
+            return lookup(call[0]).apply(null, call[1] || []);
+        });
+        send({id: req.id, results: results});
+    } catch (e) {
+        send({id: req.id, error: String(e && e.stack || e)});
+    }
+});
+rl.on("close", function () {
+    process.exit(0);
+});
+
+send({ready: true});
@@ -3,14 +3,14 @@ import math
 import random
 from pathlib import Path
 
-import execjs
+from redbook.client_v2 import native_sign
+from redbook.client_v2.signer import SignerPool
 
 STATIC_PATH = Path(__file__).parent/'static'
-NODE_PATH = Path(__file__).parent/'node_modules'
-js = execjs.compile(
-    (STATIC_PATH/'xhs_xs_xsc_56.js').read_text(), cwd=NODE_PATH)
-xray_js = execjs.compile(
-    (STATIC_PATH/'xhs_xray.js').read_text(), cwd=NODE_PATH)
+# 'native': everything but mnsv2 in python, 'node': whole bundle in node
+SIGN_BACKEND = 'native'
+js = SignerPool(native_sign.XS_BUNDLE, size=2)  # one per fetcher.SIGN_WORKERS
+xray_js = SignerPool('xhs_xray.js')
 
 
 def generate_x_b3_traceid(len=16):
@@ -21,18 +21,16 @@ def generate_x_b3_traceid(len=16):
 
 
 def generate_xs_xs_common(a1, api, data='', method='POST'):
+    if SIGN_BACKEND == 'native':
+        return native_sign.sign(js, api, data, a1)
     ret = js.call('get_request_headers_params', api, data, a1, method)
     xs, xt, xs_common = ret['xs'], ret['xt'], ret['xs_common']
     return xs, xt, xs_common
 
 
-def generate_xs(a1, api, data=''):
-    ret = js.call('get_xs', api, data, a1)
-    xs, xt = ret['X-s'], ret['X-t']
-    return xs, xt
-
-
 def generate_xray_traceid():
+    if SIGN_BACKEND == 'native':
+        return native_sign.xray_traceid()
     return xray_js.call('traceId')
 
 
@@ -120,4 +118,3 @@ def trans_cookies(cookies_str):
         ck = {i.split('=')[0]: '='.join(i.split('=')[1:])
               for i in cookies_str.split(';')}
     return ck
-    return ck
@@ -0,0 +1,194 @@
+"""
+Prioritized download slots per CDN host
+
+Each host gets its own concurrency limit, so a few large videos on the
+video hosts can no longer hold up every small image behind them. Downloads
+waiting for a slot are served by priority: images first, then live photo
+videos, avatars, and the large note videos last.
+
+Priority orders the waiters of one host. It only reaches across hosts when
+TOTAL_LIMIT caps all hosts together, which is off by default: a shared cap
+lets videos spread over several hosts take the slots before the images
+queue up, and priority can reorder waiters but not preempt a transfer.
+With 12 videos and 120 images over five hosts, benchmarks/
+bench_download_scheduler.py gives a mean image wait of 0.43s without the
+cap and 3.02s with a cap of 10.
+
+The bandwidth budget per host family in BANDWIDTH is off by default too.
+"""
+import asyncio
+import bisect
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from urllib.parse import urlsplit
+
+from redbook.limiter import TokenBucket
+
+PRIORITY = {'image': 0, 'mov': 1, 'avatar': 2, 'video': 3}
+# concurrent downloads per host, by host family (sns-img-hw -> sns-img)
+HOST_LIMITS = {
+    'sns-img': 8,
+    'sns-video': 3,
+    'sns-avatar': 2,
+    'default': 4,
+}
+# concurrent downloads over all hosts, None for no shared limit
+TOTAL_LIMIT: int | None = None
+# bytes per second per host family, None for unlimited
+BANDWIDTH: dict[str, float | None] = {
+    'sns-video': None,
+}
+
+
+def host_family(host: str) -> str:
+    return '-'.join(host.split('.')[0].split('-')[:2])
+
+
+def priority(url: str, filename: str) -> int:
+    if host_family(urlsplit(url).hostname or '') == 'sns-avatar':
+        return PRIORITY['avatar']
+    if filename.endswith('.mp4'):
+        return PRIORITY['video']
+    if filename.endswith('.mov'):
+        return PRIORITY['mov']
+    return PRIORITY['image']
+
+
+class HostQueue:
+    """slots and stats of one host, handed out by DownloadScheduler"""
+
+    def __init__(self, host: str, concurrency: int,
+                 bandwidth: float = None) -> None:
+        """
+        :param bandwidth: bytes per second, allowing a one second burst
+        """
+        self.host = host
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth and TokenBucket(
+            bandwidth, capacity=bandwidth, min_rate=bandwidth,
+            max_rate=bandwidth, tokens=bandwidth)
+        self.active = 0
+        self.depth = 0
+        self.served = 0
+        self.received = 0
+        self.waited = 0.0
+
+    @property
+    def full(self) -> bool:
+        return self.active >= self.concurrency
+
+    def __str__(self) -> str:
+        wait = self.waited / (self.served or 1)
+        return (f'{self.host}: {self.active}/{self.concurrency} active, '
+                f'depth {self.depth}, {self.served} served, '
+                f'{self.received / 2**20:.1f}MiB, {wait:.1f}s avg wait')
+
+    async def throttle(self, nbytes: int) -> None:
+        self.received += nbytes
+        if not (bucket := self.bandwidth):
+            return
+        bucket.take(amount=nbytes)
+        if bucket.tokens < 0:
+            await asyncio.sleep(-bucket.tokens / bucket.rate)
+
+
+class DownloadScheduler:
+    """
+    one priority queue over all hosts
+
+    a freed slot goes to the most urgent waiter whose host is below its
+    limit; with a total limit, an image on one host is served before a
+    video on another.
+    """
+
+    def __init__(self, limits: dict[str, int] = None,
+                 bandwidth: dict[str, float | None] = None,
+                 total: int | None = TOTAL_LIMIT) -> None:
+        self.limits = limits or HOST_LIMITS
+        self.bandwidth = BANDWIDTH if bandwidth is None else bandwidth
+        self.total = total or float('inf')
+        self.active = 0
+        self.queues: dict[str, HostQueue] = {}
+        # sorted by (priority, arrival)
+        self._waiters: list[tuple[int, int, HostQueue, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    def queue(self, url: str) -> HostQueue:
+        host = urlsplit(url).hostname or ''
+        if not (queue := self.queues.get(host)):
+            family = host_family(host)
+            queue = self.queues[host] = HostQueue(
+                host, self.limits.get(family, self.limits['default']),
+                self.bandwidth.get(family))
+        return queue
+
+    @property
+    def depth(self) -> int:
+        return sum(q.depth for q in self.queues.values())
+
+    def __str__(self) -> str:
+        if not self.queues:
+            return 'idle'
+        return '; '.join([f'{self.active} active',
+                          *map(str, self.queues.values())])
+
+    async def acquire(self, queue: HostQueue, priority: int) -> None:
+        start = time.perf_counter()
+        # slots are handed out as soon as they free up, so a free slot
+        # here means no waiter can take it
+        if self.active < self.total and not queue.full:
+            self._grant(queue)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self._seq), queue, future)
+            bisect.insort(self._waiters, entry)
+            queue.depth += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot was handed over just before cancelling
+                    self.release(queue)
+                else:
+                    self._waiters.remove(entry)
+                    queue.depth -= 1
+                raise
+        queue.waited += time.perf_counter() - start
+        queue.served += 1
+
+    def release(self, queue: HostQueue) -> None:
+        queue.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def _grant(self, queue: HostQueue) -> None:
+        queue.active += 1
+        self.active += 1
+
+    def _dispatch(self) -> None:
+        i = 0
+        while self.active < self.total and i < len(self._waiters):
+            *_, queue, future = self._waiters[i]
+            if queue.full or future.done():
+                # a cancelled waiter removes itself
+                i += 1
+                continue
+            del self._waiters[i]
+            queue.depth -= 1
+            self._grant(queue)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, url: str, priority: int
+                   ) -> AsyncIterator[HostQueue]:
+        queue = self.queue(url)
+        await self.acquire(queue, priority)
+        try:
+            yield queue
+        finally:
+            self.release(queue)
+
+
+download_scheduler = DownloadScheduler()
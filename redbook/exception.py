@@ -1,2 +1,14 @@
 class UserNotFoundError(Exception):
     pass
+
+
+class SignerError(RuntimeError):
+    pass
+
+
+class VerificationError(Exception):
+    pass
+
+
+class RangeMismatchError(Exception):
+    pass
@@ -0,0 +1,142 @@
+"""
+Which users user_loop fetches next
+
+Every UserConfig carries next_fetch_at, the time its estimated new notes
+reach DUE_POSTS. The loop keeps those in a heap built with one query at
+start; afterwards a round only reads the configs added since and the ones
+it pops, so its cost does not grow with the number of followed users.
+
+The order differs from the query it replaced. Due users are fetched
+earliest next_fetch_at first, i.e. the one that reached DUE_POSTS first,
+rather than most estimated new notes first. When few are due, the fallback
+takes the users due earliest rather than the ones fetched longest ago.
+Ranking the old way would mean scanning every user each round again.
+
+VisitBudget paces the api visits of the users fetched side by side.
+"""
+import heapq
+
+import pendulum
+from toolkit.tool import asleep
+
+from redbook import console
+from redbook.fetcher import fetcher
+from redbook.limiter import TokenBucket
+from redbook.model import UserConfig
+
+
+def _due(next_fetch_at: pendulum.DateTime | None) -> float:
+    # users never fetched are due before everyone else
+    return next_fetch_at.timestamp() if next_fetch_at else float('-inf')
+
+
+class FetchSchedule:
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, int]] = []
+        # due time of each scheduled config, heap entries that disagree
+        # with it are stale and skipped when they surface
+        self._due_at: dict[int, float] = {}
+        self._max_id = 0
+
+    def __len__(self) -> int:
+        return len(self._due_at)
+
+    def push(self, config: UserConfig) -> None:
+        self._push(config.id, _due(config.next_fetch_at))
+
+    def _push(self, config_id: int, due: float) -> None:
+        self._due_at[config_id] = due
+        heapq.heappush(self._heap, (due, config_id))
+
+    def sync(self) -> int:
+        """schedule the configs added since the last sync"""
+        query = (UserConfig.select(UserConfig.id, UserConfig.next_fetch_at)
+                 .where(UserConfig.note_fetch, UserConfig.id > self._max_id))
+        added = 0
+        for config in query:
+            self.push(config)
+            self._max_id = max(self._max_id, config.id)
+            added += 1
+        return added
+
+    def peek(self, n: int = 10) -> list[tuple[pendulum.DateTime | None, int]]:
+        """next_fetch_at and id of the n configs due first"""
+        entries = heapq.nsmallest(n, self._due_at.items(),
+                                  key=lambda item: item[1])
+        return [(None if due == float('-inf') else
+                 pendulum.from_timestamp(due, tz='local'), config_id)
+                for config_id, due in entries]
+
+    def _pop(self, before: float = None) -> UserConfig | None:
+        while self._heap:
+            due, config_id = self._heap[0]
+            if self._due_at.get(config_id) != due:
+                heapq.heappop(self._heap)
+                continue
+            if before is not None and due > before:
+                return None
+            heapq.heappop(self._heap)
+            del self._due_at[config_id]
+            config = UserConfig.get_or_none(id=config_id)
+            if not config or not config.note_fetch:
+                continue
+            if (current := _due(config.next_fetch_at)) != due:
+                # fetched by another command meanwhile
+                self._push(config_id, current)
+                continue
+            return config
+
+    def take(self, limit: int, min_due: int = 10,
+             fallback: int = 3) -> list[UserConfig]:
+        """
+        pop the configs to fetch this round, the ones that became due
+        first
+
+        when fewer than min_due are due and none of them is new, only the
+        fallback configs due first are taken, due or not. push() them back
+        once fetched (or not).
+        """
+        now = pendulum.now().timestamp()
+        batch = []
+        while len(batch) < limit and (config := self._pop(before=now)):
+            batch.append(config)
+        if (len(batch) >= min_due or
+                any(c.note_fetch_at is None for c in batch)):
+            return batch
+        while len(batch) < fallback and (config := self._pop()):
+            batch.append(config)
+        for config in batch[fallback:]:
+            self.push(config)
+        return batch[:fallback]
+
+
+class VisitBudget:
+    """
+    api visits user_loop may spend: one per ``seconds_per_visit`` on
+    average, the pace the sequential loop kept by sleeping 30 seconds per
+    visit after each user
+
+    visits are charged after the fact from fetcher.visits, whoever made
+    them, so users fetched concurrently share one budget.
+    """
+
+    def __init__(self, seconds_per_visit: float = 30,
+                 burst: float = 1) -> None:
+        self.bucket = TokenBucket(
+            1 / seconds_per_visit, capacity=burst,
+            min_rate=1 / seconds_per_visit, max_rate=1 / seconds_per_visit,
+            tokens=burst)
+        self._visits = fetcher.visits
+
+    def _charge(self) -> None:
+        if spent := fetcher.visits - self._visits:
+            self._visits += spent
+            self.bucket.take(amount=spent)
+
+    async def wait(self) -> None:
+        """wait until the visits spent so far are paid off"""
+        self._charge()
+        while (wait_time := self.bucket.wait_time()) > 0:
+            console.log(f'sleep {wait_time:.0f} seconds for the visit budget')
+            await asleep(wait_time)
+            self._charge()
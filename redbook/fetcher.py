@@ -1,40 +1,125 @@
 import asyncio
+import json
 import logging
-import random
+import select
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-import httpx
 from httpx import AsyncClient, HTTPError, HTTPStatusError, Response
 from toolkit.tool import asleep, get_arc_cookies
 
 from redbook import console
 from redbook.client_v2.xhs_util import generate_headers, splice_str
+from redbook.exception import VerificationError
+from redbook.limiter import RateLimiter
+from redbook.transport import api_client
 
 httpx_logger = logging.getLogger("httpx")
 httpx_logger.disabled = True
 
 BASE_URL = 'https://edith.xiaohongshu.com'
+SIGN_WORKERS = 2
+# cookie profiles in the pool, one account each: 'default' and 'main' are
+# the two Arc profiles, any other name is read from COOKIE_DIR/<name>.json
+PROFILES = ['default']
+COOKIE_DIR = Path.home() / '.config' / 'redbook' / 'cookies'
+PARK_SECONDS = 3600
+# seconds between loop lag probes while a sign is in flight
+LAG_INTERVAL = 0.005
+sign_executor = ThreadPoolExecutor(
+    SIGN_WORKERS, thread_name_prefix='redbook-sign')
 
 
-class Fetcher:
+class LoopLag:
+    """
+    worst delay of the event loop while running
+
+    a probe is scheduled every interval with call_at, the lag is how late
+    it actually runs behind the time it was scheduled for
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 interval: float = LAG_INTERVAL) -> None:
+        self.loop = loop
+        self.interval = interval
+        self.worst = 0.0
+        self._schedule()
+
+    def _schedule(self) -> None:
+        self._due = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._due, self._probe)
+
+    def _probe(self) -> None:
+        self.worst = max(self.worst, self.loop.time() - self._due)
+        self._schedule()
+
+    def stop(self) -> float:
+        self._handle.cancel()
+        # a probe that is overdue but did not get to run is lagging too
+        return max(self.worst, self.loop.time() - self._due)
+
+
+class SignStats:
+    """worst loop lag while signing and time spent in the executor"""
+
     def __init__(self) -> None:
+        self.count = 0
+        self.loop_lag = 0.0
+        self.signing = 0.0
+
+    def add(self, loop_lag: float, signing: float) -> None:
+        self.count += 1
+        self.loop_lag += loop_lag
+        self.signing += signing
+
+    def __add__(self, other: 'SignStats') -> 'SignStats':
+        stats = SignStats()
+        stats.count = self.count + other.count
+        stats.loop_lag = self.loop_lag + other.loop_lag
+        stats.signing = self.signing + other.signing
+        return stats
+
+    def __str__(self) -> str:
+        count = self.count or 1
+        return (f'{self.count} signs, loop lag '
+                f'{self.loop_lag / count * 1000:.2f}ms/request, '
+                f'signing {self.signing / count * 1000:.1f}ms/request')
+
+
+class Fetcher:
+    def __init__(self, profile: str = 'default') -> None:
+        self.name = profile
         self.cookies: dict = None
         self.client: AsyncClient = None
-        self._visit_count = 0
         self.visits = 0
-        self._last_fetch = time.time()
+        self.inflight = 0
+        self.parked_until = 0.0
+        self._unparking: asyncio.Task | None = None
+        self.limiter = RateLimiter(
+            prefix='' if profile == 'default' else f'{profile}:')
+        self.sign_stats = SignStats()
 
     async def aclose(self) -> None:
-        if self.client:
-            await self.client.aclose()
-            self.client = None
-            self.cookies = None
+        """
+        forget the cookies, they are re-read on the next request, and
+        write the rate budgets changed since their last save
+
+        the client and its pooled connections are kept for reuse
+        """
+        self.cookies = None
+        self.limiter.flush()
 
     def renew_client(self) -> None:
         console.log('renewing client...')
-        self.cookies = get_arc_cookies(
-            'https://xiaohongshu.com', main_profile=False)
-        self.client = httpx.AsyncClient(cookies=self.cookies)
+        self.cookies = load_cookies(self.name)
+        if self.client is None:
+            self.client = api_client(self.cookies)
+        else:
+            self.client.cookies.clear()
+            self.client.cookies.update(self.cookies)
 
     async def login(self):
         r = await self.get('/api/sns/web/v2/user/me')
@@ -44,12 +129,14 @@ class Fetcher:
         raise ValueError(f'not logined: {js}')
 
     async def request(self, method, url, **kwargs) -> Response:
-        if not self.client:
+        if not self.cookies:
             self.renew_client()
         for try_time in range(1, 20):
             try:
-                await self._pause()
+                self.visits += 1
+                await self.limiter.acquire(url)
                 r = await self.client.request(method, url, **kwargs)
+                self.limiter.feedback(url, r.status_code)
                 r.raise_for_status()
             except asyncio.CancelledError:
                 console.log(f'{method} {url}  was cancelled.', style='error')
@@ -58,8 +145,9 @@ class Fetcher:
                 if isinstance(e, HTTPStatusError):
                     if r.status_code in [461, 302]:
                         console.log(r.text)
-                        input(f'{r.status_code} ERROR, verification needed...')
-                        continue
+                        raise VerificationError(
+                            f'{r.status_code} ERROR on account {self.name}, '
+                            'verification needed...') from e
                     if r.status_code == 406:
                         raise ValueError(f'Failed to fetch: {r.text}') from e
                 period = 30 * ((try_time % 10) or 30)
@@ -74,54 +162,153 @@ class Fetcher:
 
     async def get(self, api, params: dict = None) -> Response:
         splice_api = splice_str(api, params)
-        headers, _ = self.get_headers(splice_api, method='GET')
-        return await self.request('GET', BASE_URL+splice_api, headers=headers)
+        self.inflight += 1
+        try:
+            headers, _ = await self.sign(splice_api, method='GET')
+            return await self.request(
+                'GET', BASE_URL+splice_api, headers=headers)
+        finally:
+            self.inflight -= 1
 
     async def post(self, api, data: dict) -> Response:
-        headers, data = self.get_headers(api, data=data, method='POST')
-        return await self.request('POST', BASE_URL+api, headers=headers, data=data)
+        self.inflight += 1
+        try:
+            headers, data = await self.sign(api, data=data, method='POST')
+            return await self.request(
+                'POST', BASE_URL+api, headers=headers, data=data)
+        finally:
+            self.inflight -= 1
+
+    @property
+    def parked(self) -> bool:
+        return self.parked_until > time.time()
+
+    def park(self) -> None:
+        self.parked_until = time.time() + PARK_SECONDS
+        console.log(f'account {self.name} parked until '
+                    f'{time.strftime("%H:%M:%S", time.localtime(self.parked_until))}',
+                    style='error')
+
+    async def wait_unparked(self) -> None:
+        """
+        wait until the park ends or the operator confirms the verification
+        is solved, without blocking the event loop
+
+        requests waiting together share one prompt
+        """
+        if not self.parked:
+            self.parked_until = 0.0
+            return
+        if not self._unparking or self._unparking.done():
+            self._unparking = asyncio.create_task(self._unpark())
+        await asyncio.shield(self._unparking)
+
+    async def _unpark(self) -> None:
+        wait = self.parked_until - time.time()
+        console.log(f'all accounts parked, solve the verification of '
+                    f'account {self.name} in the browser and press enter, '
+                    f'or wait {wait / 60:.0f} minutes...', style='error')
+        stop = threading.Event()
+        answer = asyncio.create_task(asyncio.to_thread(_read_line, stop))
+        try:
+            await asyncio.wait([answer], timeout=wait)
+        finally:
+            stop.set()
+        if answer.done() and answer.result() is not None:
+            console.log(f'account {self.name} unparked')
+        self.parked_until = 0.0
 
-    def get_headers(self, api: str, data: dict = None, method: str = 'POST'):
+    async def sign(self, api: str, data: dict = None, method: str = 'POST'):
+        """generate signed headers in sign_executor, off the event loop"""
         if not self.cookies:
             self.renew_client()
-        headers, data = generate_headers(self.cookies['a1'], api, data, method)
+        loop = asyncio.get_running_loop()
+        lag = LoopLag(loop)
+        try:
+            headers, data, signing = await loop.run_in_executor(
+                sign_executor, _timed_sign,
+                self.cookies['a1'], api, data, method)
+        finally:
+            loop_lag = lag.stop()
+        self.sign_stats.add(loop_lag, signing)
         return headers, data
 
-    async def _pause(self):
-        self.visits += 1
-        if self._visit_count == 0:
-            self._visit_count = 1
-            self._last_fetch = time.time()
-            return
 
-        if self._visit_count % 64 == 0:
-            sleep_time = 64
-        elif self._visit_count % 16 == 0:
-            sleep_time = 16
-        elif self._visit_count % 4 == 0:
-            sleep_time = 4
-        else:
-            sleep_time = 2
-        sleep_time *= random.uniform(0.8, 1.2) * 4
-        self._last_fetch += sleep_time
-        if (wait_time := self._last_fetch-time.time()) > 0:
-            console.log(
-                f'sleep {wait_time:.1f} seconds...'
-                f'(count: {self._visit_count})',
-                style='info')
-            await asleep(wait_time)
-        elif wait_time < -3600:
-            self._visit_count = 0
-            console.log(
-                f'reset visit count to {self._visit_count} since have '
-                f'no activity for {wait_time:.1f} seconds, '
-                'which means  more than 1 hour passed')
-        else:
-            console.log(
-                f'no sleeping since more than {sleep_time:.1f} seconds passed'
-                f'(count: {self._visit_count})')
-        self._last_fetch = time.time()
-        self._visit_count += 1
+def load_cookies(profile: str) -> dict:
+    if profile in ('default', 'main'):
+        return get_arc_cookies('https://xiaohongshu.com',
+                               main_profile=profile == 'main')
+    return json.loads((COOKIE_DIR / f'{profile}.json').read_text())
+
+
+def _read_line(stop: threading.Event) -> str | None:
+    """a line from stdin, or None once stop is set or stdin is closed"""
+    while not stop.is_set():
+        if select.select([sys.stdin], [], [], 1)[0]:
+            if line := sys.stdin.readline():
+                return line
+            # no operator to answer, leave it to the park timer
+            stop.wait()
+
+
+def _timed_sign(a1: str, api: str, data: dict, method: str):
+    start = time.perf_counter()
+    headers, data = generate_headers(a1, api, data, method)
+    return headers, data, time.perf_counter() - start
+
+
+class FetcherPool:
+    """
+    Route requests over several accounts
+
+    each request goes to the healthy account with the fewest requests in
+    flight, an account hitting a verification challenge is parked while the
+    others keep going. When all of them are parked, requests wait for the
+    earliest park to end, or for the operator to confirm it is solved.
+    """
+
+    def __init__(self, fetchers: list[Fetcher]) -> None:
+        assert fetchers
+        assert len({f.name for f in fetchers}) == len(fetchers), \
+            'duplicate cookie profiles'
+        self.fetchers = fetchers
+
+    @property
+    def visits(self) -> int:
+        return sum(f.visits for f in self.fetchers)
+
+    @property
+    def sign_stats(self) -> SignStats:
+        return sum((f.sign_stats for f in self.fetchers), SignStats())
+
+    def pick(self) -> Fetcher | None:
+        if healthy := [f for f in self.fetchers if not f.parked]:
+            return min(healthy, key=lambda f: (f.inflight, f.visits))
+
+    async def _dispatch(self, method: str, *args) -> Response:
+        while True:
+            if not (fetcher := self.pick()):
+                fetcher = min(self.fetchers, key=lambda f: f.parked_until)
+                await fetcher.wait_unparked()
+            try:
+                return await getattr(fetcher, method)(*args)
+            except VerificationError as e:
+                console.log(e, style='error')
+                fetcher.park()
+
+    async def get(self, api, params: dict = None) -> Response:
+        return await self._dispatch('get', api, params)
+
+    async def post(self, api, data: dict) -> Response:
+        return await self._dispatch('post', api, data)
+
+    async def login(self) -> str:
+        names = [await f.login() for f in self.fetchers]
+        return ', '.join(names)
+
+    async def aclose(self) -> None:
+        for f in self.fetchers:
+            await f.aclose()
 
 
-fetcher = Fetcher()
+fetcher = FetcherPool([Fetcher(p) for p in PROFILES])
@@ -1,36 +1,65 @@
 import asyncio
+import hashlib
 import json
 import mimetypes
+import os
 import re
+import shutil
 import sys
-from functools import wraps
+import tempfile
+import time
+from functools import cache, wraps
 from pathlib import Path
-from typing import AsyncIterable
+from typing import Awaitable, Callable
 
-import execjs
 import httpx
-import magic
 import pendulum
-import truststore
-from exiftool import ExifToolHelper
 from humanize import naturalsize
 from makelive import is_live_photo_pair, live_id, make_live_photo
 from makelive.makelive import (
     add_asset_id_to_image_file,
     add_asset_id_to_quicktime_file
 )
+from rich.prompt import Confirm
 from toolkit.record import save_log
 
 from redbook import console
+from redbook.download_scheduler import download_scheduler, priority
+from redbook.exception import RangeMismatchError
+from redbook.metadata import xmp_writer
+from redbook.transport import cdn_client
 
-truststore.inject_into_ssl()
 if not (d := Path('/Volumes/Art')).exists():
     d = Path.home()/'Pictures'
 SAVE_PATH = d / 'RedBook'
-semaphore = asyncio.Semaphore(10)
-client = httpx.AsyncClient()
-et = ExifToolHelper()
-mime_detector = magic.Magic(mime=True)
+# local disk where media are finalized before moving to SAVE_PATH
+SCRATCH_PATH = Path(tempfile.gettempdir()) / 'redbook'
+SCRATCH_PATH.mkdir(exist_ok=True)
+CHUNK_SIZE = 1 << 16
+# bytes of a download buffered before they are hashed and written off the loop
+WRITE_SIZE = 1 << 20
+# one prompt at a time when users are fetched side by side
+_prompt_lock = asyncio.Lock()
+
+
+@cache
+def mime_detector():
+    # loading the libmagic database is slow, only downloads need it
+    import magic
+    return magic.Magic(mime=True)
+
+
+async def confirm(question: str, *context) -> bool:
+    """
+    Confirm.ask for fetches running side by side
+
+    one question at a time, printed right after its context; the answer is
+    read in a thread so the downloads of the other fetches go on meanwhile
+    """
+    async with _prompt_lock:
+        for renderable in context:
+            console.log(renderable)
+        return await asyncio.to_thread(Confirm.ask, question)
 
 
 def normalize_user_id(user_id: str) -> str:
@@ -45,6 +74,7 @@ def convert_js_dict_to_py(js_dict: str) -> dict:
     """
     convert a JavaScript dictionary to a Python dictionary
     """
+    import execjs
     js_code = f"var dict = {js_dict}; JSON.stringify(dict);"
     ctx = execjs.compile("""
         function convertJsToPy(jsCode) {
@@ -60,43 +90,86 @@ def convert_js_dict_to_py(js_dict: str) -> dict:
         raise
 
 
-async def download_files(imgs: AsyncIterable[list[dict]]):
-    tasks: dict[asyncio.Task, list] = {}
-    failed_tasks: dict[asyncio.Task, list] = {}
-    async for img in imgs:
-        task = asyncio.create_task(download_file_pair(img))
-        tasks[task] = img
-        for task in list(tasks):
-            if task.done():
-                img = tasks.pop(task)
-                if task.exception():
-                    failed_tasks[task] = img
-        if failed_tasks:
-            for task in list(tasks):
-                task.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
-            task, img = failed_tasks.popitem()
-            console.log(f'{img} failed')
-            raise task.exception()
-    await asyncio.gather(*tasks)
-
-
-async def download_file_pair(medias: list[dict]):
+async def download_file_pair(
+        medias: list[dict]) -> list[tuple[Path, str | None]]:
+    """
+    :return: path and md5 of each media in place, md5 is None for files
+        which were there already
+    """
     if len(medias) == 1:
-        await download_single_file(**medias[0])
-        return
+        return [await _download_single(**medias[0])]
     img_info, mov_info = medias
     img_xmp = img_info.pop('xmp_info')
     mov_xmp = mov_info.pop('xmp_info')
+    img_path, img_digest = await _resolve(img_info, img_xmp)
+    mov_path, mov_digest = await _resolve(mov_info, mov_xmp)
+    if img_path and mov_path:
+        console.log(f'{img_path} and {mov_path.name} already exists..'
+                    'skipping...', style='info')
+        return [(img_path, None), (mov_path, None)]
+    if (existing := img_path or mov_path) and (
+            asset_id := await asyncio.to_thread(live_id, existing)):
+        # the half in place carries its asset id already: only the other
+        # half is fetched and tagged to match, the file in place is kept
+        if img_path:
+            saved = await _complete_pair(
+                mov_info, mov_xmp, mov_digest, asset_id)
+            return [(img_path, None), saved]
+        saved = await _complete_pair(img_info, img_xmp, img_digest, asset_id)
+        return [saved, (mov_path, None)]
+    # otherwise both halves are finalized together, a half in place is
+    # replaced by its new copy when published
+    scratch = []
     try:
-        img_path = await download_single_file(**img_info)
-        mov_path = await download_single_file(**mov_info)
+        # both halves are fetched side by side, each in its host's queue
+        sourced = await asyncio.gather(
+            _source_to_scratch(**img_info), _source_to_scratch(**mov_info),
+            return_exceptions=True)
+        scratch = [s[0] for s in sourced if isinstance(s, tuple)]
+        for s in sourced:
+            if isinstance(s, BaseException):
+                raise s
+        (img_path, img_reused), (mov_path, mov_reused) = sourced
+        # everything below rewrites the scratch copies, the files under
+        # filepath are written once when published
+        await asyncio.to_thread(link_live_photo, img_path, mov_path)
+        scratch = await asyncio.gather(
+            xmp_writer.write(img_path, img_xmp, reset=img_reused),
+            xmp_writer.write(mov_path, mov_xmp, reset=mov_reused))
+        img_path, mov_path = scratch
     except Exception:
-        if (img_path := img_info['filepath']/img_info['filename']).exists():
-            img_path.unlink()
-        if (mov_path := mov_info['filepath']/mov_info['filename']).exists():
-            mov_path.unlink()
+        for path in scratch:
+            path.unlink(missing_ok=True)
         raise
+    return [await _save(img_path, img_info, img_digest),
+            await _save(mov_path, mov_info, mov_digest)]
+
+
+async def _complete_pair(info: dict, xmp_info: dict, digest: str,
+                         asset_id: str) -> tuple[Path, str]:
+    """fetch the missing half of a live photo and give it asset_id"""
+    path, reused = await _source_to_scratch(**info)
+    add_id = (add_asset_id_to_quicktime_file if path.suffix in ['.mov', '.mp4']
+              else add_asset_id_to_image_file)
+    try:
+        if await asyncio.to_thread(live_id, path) != asset_id:
+            await asyncio.to_thread(add_id, path, asset_id)
+        path = await xmp_writer.write(path, xmp_info, reset=reused)
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    return await _save(path, info, digest)
+
+
+async def _save(path: Path, info: dict, digest: str) -> tuple[Path, str]:
+    """publish a finalized scratch file, return where it went and its md5"""
+    checksum = await asyncio.to_thread(file_md5, path)
+    path = await _publish(path, info, digest)
+    console.log(f'🎉 {path} successfully downloaded...', style="dim")
+    return path, checksum
+
+
+def link_live_photo(img_path: Path, mov_path: Path):
     img_size = naturalsize(img_path.stat().st_size)
     mov_size = naturalsize(mov_path.stat().st_size)
     if not is_live_photo_pair(img_path, mov_path):
@@ -112,39 +185,329 @@ async def download_file_pair(medias: list[dict]):
     if (x := naturalsize(mov_path.stat().st_size)) != mov_size:
         console.log(f'{mov_path.name} size changed from {mov_size} to {x}')
     assert is_live_photo_pair(img_path, mov_path)
-    write_xmp(img_path, img_xmp)
-    write_xmp(mov_path, mov_xmp)
+
 
 USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
               "Chrome/115.0.0.0 Safari/537.36 Edg/115.0.1901.188")
 
 
+def _suffixes(img: Path) -> list[str]:
+    if img.suffix in (suffixs := ['.mp4', '.mov']):
+        return suffixs
+    suffixs = ['.webp', '.jpg', '.heic', '.png', '.heif']
+    assert img.suffix in suffixs, img
+    return suffixs
+
+
+class DirIndex:
+    """
+    file names of each directory looked at, grouped by stem
+
+    a directory is listed once with os.scandir and kept up to date by
+    add() and discard(). Its mtime is checked at most every ``ttl``
+    seconds, and it is listed again when it moved since the listing. The
+    recorded mtime is only taken by a listing: our own changes move it as
+    well, so they cost a rescan, but a change someone else made in the
+    same moment is never taken for ours.
+    """
+
+    def __init__(self, ttl: float = 60) -> None:
+        self.ttl = ttl
+        self._dirs: dict[Path, tuple[int, float, dict[str, set[str]]]] = {}
+
+    @staticmethod
+    def _mtime(directory: Path) -> int:
+        try:
+            return directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _scan(self, directory: Path) -> dict[str, set[str]]:
+        mtime, stems = self._mtime(directory), {}
+        if mtime:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    stem = entry.name.rsplit('.', maxsplit=1)[0]
+                    stems.setdefault(stem, set()).add(entry.name)
+        self._dirs[directory] = mtime, time.monotonic(), stems
+        return stems
+
+    def stems(self, directory: Path) -> dict[str, set[str]]:
+        if not (cached := self._dirs.get(directory)):
+            return self._scan(directory)
+        mtime, checked_at, stems = cached
+        if time.monotonic() - checked_at > self.ttl:
+            if self._mtime(directory) != mtime:
+                return self._scan(directory)
+            self._dirs[directory] = mtime, time.monotonic(), stems
+        return stems
+
+    def find(self, img: Path, suffixes: list[str]) -> Path | None:
+        names = self.stems(img.parent).get(img.stem, ())
+        for suffix in suffixes:
+            if img.stem + suffix in names:
+                return img.with_suffix(suffix)
+
+    def add(self, path: Path) -> None:
+        if (directory := path.parent) not in self._dirs:
+            return
+        _, _, stems = self._dirs[directory]
+        stems.setdefault(path.stem, set()).add(path.name)
+
+    def discard(self, path: Path) -> None:
+        if (directory := path.parent) not in self._dirs:
+            return
+        _, _, stems = self._dirs[directory]
+        if names := stems.get(path.stem):
+            names.discard(path.name)
+
+
+dir_index = DirIndex()
+
+
+def existing_file(img: Path) -> Path | None:
+    """img under any of the suffixes its media type may end up with"""
+    return dir_index.find(img, _suffixes(img))
+
+
+async def commit_file(src: Path, filepath: Path) -> Path:
+    """move a finished scratch file to filepath in a single write"""
+    if src.parent == filepath:
+        return src
+    filepath.mkdir(parents=True, exist_ok=True)
+    dest = filepath / src.name
+    try:
+        src.replace(dest)
+    except OSError:
+        # another volume: copy next to dest off the loop, then rename
+        await asyncio.to_thread(_copy_replace, src, dest)
+        src.unlink()
+    dir_index.add(dest)
+    return dest
+
+
+def _copy_replace(src: Path, dest: Path) -> None:
+    """copy src next to dest, then rename it over dest atomically"""
+    tmp = dest.with_name(dest.name + '.tmp')
+    shutil.copyfile(src, tmp)
+    tmp.replace(dest)
+
+
+class MediaStore:
+    """
+    finalized media keyed by content, shared by every folder via hardlinks
+
+    a blob is named after its key (pic_id, or the video url) and a digest
+    of the xmp written into it, so the same note saved under User/, New/
+    and Revisit/ links one file, while a repost by another user (other
+    xmp) is finalized from a copy of the blob instead of downloaded again.
+
+    where folders cannot hardlink the store, found out by the first link
+    failing, nothing is stored any more and files are published directly.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.linkable = True
+
+    @staticmethod
+    def digest(xmp_info: dict = None) -> str:
+        meta = json.dumps(xmp_info or {}, sort_keys=True,
+                          ensure_ascii=False, default=str)
+        return hashlib.sha1(meta.encode()).hexdigest()[:12]
+
+    def _blob(self, key: str, digest: str = '') -> Path:
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return self.root / name[:2] / f'{name[2:]}_{digest}'
+
+    def find(self, key: str, digest: str, suffixes: list[str]) -> Path | None:
+        blob = self._blob(key, digest)
+        return dir_index.find(blob.with_name(blob.name + suffixes[0]),
+                              suffixes)
+
+    def find_any(self, key: str, suffixes: list[str]) -> Path | None:
+        """a blob of key, whatever xmp it carries"""
+        blob = self._blob(key)
+        for stem, names in dir_index.stems(blob.parent).items():
+            if not stem.startswith(blob.name):
+                continue
+            for name in names:
+                if Path(name).suffix in suffixes:
+                    return blob.parent / name
+
+    async def add(self, path: Path, key: str, digest: str) -> Path:
+        blob = self._blob(key, digest)
+        path = path.rename(path.with_name(blob.name + path.suffix))
+        return await commit_file(path, blob.parent)
+
+    async def link(self, blob: Path, filepath: Path, filename: str) -> Path:
+        """
+        put blob at filepath/filename, replacing a file left there by an
+        earlier finalization of the same media
+        """
+        filepath.mkdir(parents=True, exist_ok=True)
+        dest = filepath / (Path(filename).stem + blob.suffix)
+        if dest.exists() and dest.samefile(blob):
+            return dest
+        tmp = dest.with_name(dest.name + '.tmp')
+        try:
+            tmp.unlink(missing_ok=True)
+            os.link(blob, tmp)
+            tmp.replace(dest)
+        except OSError as e:
+            # no hardlinks on this volume, or another volume
+            if self.linkable:
+                console.log(f'{e!r}: cannot link from {self.root}, '
+                            'files are no longer stored there',
+                            style='error')
+                self.linkable = False
+            await asyncio.to_thread(_copy_replace, blob, dest)
+        dir_index.add(dest)
+        return dest
+
+    def discard(self, blob: Path) -> None:
+        blob.unlink(missing_ok=True)
+        dir_index.discard(blob)
+
+    def gc(self) -> tuple[int, int]:
+        """
+        delete the blobs no folder links to any more, e.g. after their
+        files were rewritten by write_meta or deleted by hand
+
+        run it while nothing is downloading: a blob is unlinked between
+        add() and link(). Blobs left from before the store turned out not
+        to be linkable are unlinked too, and deleted.
+
+        :return: number of blobs deleted and bytes freed
+        """
+        count = freed = 0
+        for blob in self.root.glob('*/*'):
+            if (stat := blob.stat()).st_nlink > 1:
+                continue
+            self.discard(blob)
+            count, freed = count + 1, freed + stat.st_size
+        return count, freed
+
+
+media_store = MediaStore(SAVE_PATH / '.store')
+
+
+async def _resolve(info: dict, xmp_info: dict) -> tuple[Path | None, str]:
+    """
+    the file of a media if it is already in place, linking it from the
+    store when a blob with the same key and xmp exists
+
+    :return: path or None, and the xmp digest for publishing
+    """
+    img = info['filepath'] / info['filename']
+    digest = media_store.digest(xmp_info) if info.get('key') else None
+    if found := existing_file(img):
+        return found, digest
+    if not digest:
+        return None, None
+    if blob := media_store.find(info['key'], digest, _suffixes(img)):
+        found = await media_store.link(
+            blob, info['filepath'], info['filename'])
+        console.log(f'{found} linked from media store', style='info')
+    return found, digest
+
+
+async def _source_to_scratch(url: str, filepath: Path, filename: str,
+                             key: str = None) -> tuple[Path, bool]:
+    """
+    a scratch copy of the media, copied from the store when a blob of the
+    same key exists and downloaded otherwise
+
+    :return: the copy and whether it came from the store
+    """
+    if key and (blob := media_store.find_any(
+            key, _suffixes(SCRATCH_PATH / filename))):
+        img = SCRATCH_PATH / (Path(filename).stem + blob.suffix)
+        await asyncio.to_thread(shutil.copyfile, blob, img)
+        console.log(f'{img.name} copied from media store', style='dim')
+        return img, True
+    return await download_to_scratch(url, filepath, filename), False
+
+
+async def _publish(img: Path, info: dict, digest: str) -> Path:
+    """move a finalized scratch file into its folder, via the store if keyed"""
+    if (key := info.get('key')) and media_store.linkable:
+        blob = await media_store.add(img, key, digest)
+        path = await media_store.link(blob, info['filepath'], info['filename'])
+        if not media_store.linkable:
+            # the link failed just now, keep the published copy only
+            media_store.discard(blob)
+        return path
+    return await commit_file(img, info['filepath'])
+
+
+def file_md5(path: Path) -> str:
+    return _md5_of(path).hexdigest()
+
+
+def _md5_of(path: Path):
+    md5 = hashlib.md5()
+    with path.open('rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            md5.update(chunk)
+    return md5
+
+
 async def download_single_file(
         url: str,
         filepath: Path,
         filename: str,
-        xmp_info: dict = None
+        xmp_info: dict = None,
+        key: str = None,
 ) -> Path:
-    filepath.mkdir(parents=True, exist_ok=True)
-    img = filepath / filename
-    headers = {"user-agent": USER_AGENT}
-    if img.suffix not in (suffixs := ['.mp4', '.mov']):
-        suffixs = ['.webp', '.jpg', '.heic', '.png', '.heif']
-        assert img.suffix in suffixs, img
-    for suffix in suffixs:
-        if (i := img.with_suffix(suffix)).exists():
-            console.log(f'{i} already exists..skipping...', style='info')
-            return i
+    """
+    :param key: content id of the media (pic_id or video url), media with a
+        key go through media_store
+    """
+    img, _ = await _download_single(url, filepath, filename, xmp_info, key)
+    return img
+
+
+async def _download_single(url, filepath, filename, xmp_info=None, key=None):
+    info = {'url': url, 'filepath': filepath,
+            'filename': filename, 'key': key}
+    img, digest = await _resolve(info, xmp_info)
+    if img:
+        console.log(f'{img} already exists..skipping...', style='info')
+        return img, None
+    img, reused = await _source_to_scratch(**info)
+    if xmp_info:
+        img = await xmp_writer.write(img, xmp_info, reset=reused)
+    return await _save(img, info, digest)
+
 
+async def download_to_scratch(url: str, filepath: Path, filename: str) -> Path:
+    """
+    download url into SCRATCH_PATH with the suffix its content calls for
+
+    the file is finalized (live photo id, xmp) there and moved to filepath
+    afterwards, so that filepath only sees one write per file.
+    """
+    img = SCRATCH_PATH / filename
+    suffixs = _suffixes(img)
+    headers = {"user-agent": USER_AGENT}
+    part = img.with_name(img.name + '.part')
     while True:
         try:
-            async with semaphore:
-                r = await client.get(url, headers=headers)
+            async with download_scheduler.slot(
+                    url, priority(url, filename)) as queue:
+                r, mime, checksum, length = await _stream_to_file(
+                    url, headers, part, queue.throttle)
+        except RangeMismatchError as e:
+            _discard_part(part)
+            console.log(f'{e}, downloading {img.name} again', style='error')
+            continue
         except httpx.HTTPError as e:
             period = 60
             console.log(
-                f"{e!r}: sleep {period} seconds and "
-                f"retry [link={url}]{url}[/link]...", style='error')
+                f"{e!r}: sleep {period} seconds and resume from "
+                f"{_part_size(part)} bytes [link={url}]{url}[/link]...",
+                style='error')
             await asyncio.sleep(period)
             continue
         except asyncio.CancelledError:
@@ -152,48 +515,152 @@ async def download_single_file(
             raise
 
         if r.status_code == 404:
-            raise ValueError(f"{url}, {xmp_info}, {r.status_code}")
-        if r.status_code != 200:
+            _discard_part(part)
+            raise ValueError(f"{url}, {filepath / filename}, {r.status_code}")
+        if checksum is None:
+            if r.status_code == 416:
+                _discard_part(part)
             console.log(
                 f"{url}, {r.status_code}, retrying download after 15 seconds",
                 style="error")
             await asyncio.sleep(15)
             continue
-        if int(r.headers['Content-Length']) != len(r.content):
-            console.log(f"expected length: {r.headers['Content-Length']}, "
-                        f"actual length: {len(r.content)} for {img}",
+        if length != (size := part.stat().st_size):
+            if size > length:
+                _discard_part(part)
+            console.log(f"expected length: {length}, "
+                        f"actual length: {size} for {img}",
                         style="error")
-            console.log(f'retrying download for {img}')
+            console.log(f'resuming download for {img}')
             continue
 
-        mime = mime_detector.from_buffer(r.content)
         suffix = mimetypes.guess_extension(mime)
         assert suffix in suffixs
         if mime.startswith('image/'):
             img = img.with_suffix(suffix)
 
-        img.write_bytes(r.content)
-
-        if xmp_info:
-            write_xmp(img, xmp_info)
-        console.log(f'🎉 {img} successfully downloaded...', style="dim")
+        part.replace(img)
+        _part_state_file(part).unlink(missing_ok=True)
+        console.log(f'{img.name} fetched (md5: {checksum})', style='dim')
         return img
 
 
-def write_xmp(img: Path, tags: dict):
-    for k, v in tags.copy().items():
-        if isinstance(v, str):
-            tags[k] = v.replace('\n', '&#x0a;')
-    params = ['-overwrite_original', '-ignoreMinorErrors', '-escapeHTML']
-    ext = et.get_tags(img, 'File:FileTypeExtension')[
-        0]['File:FileTypeExtension'].lower()
-    if (suffix := f'.{ext}') != img.suffix:
-        new_img = img.with_suffix(suffix)
-        console.log(
-            f'{img}: suffix is not right, moving to {new_img}...',
-            style='error')
-        img = img.rename(new_img)
-    et.set_tags(img, tags, params=params)
+def _part_state_file(part: Path) -> Path:
+    return part.with_name(part.name + '.json')
+
+
+def _part_size(part: Path) -> int:
+    return part.stat().st_size if part.exists() else 0
+
+
+def _discard_part(part: Path):
+    part.unlink(missing_ok=True)
+    _part_state_file(part).unlink(missing_ok=True)
+
+
+def _load_part_state(part: Path, url: str) -> dict:
+    """sidecar state of a partial download, empty if it can not be resumed"""
+    state_file = _part_state_file(part)
+    if not (part.exists() and state_file.exists()):
+        return {}
+    state = json.loads(state_file.read_text())
+    if state['url'] != url or not (state['etag'] or state['last_modified']):
+        return {}
+    if state['length'] < part.stat().st_size:
+        return {}
+    return state
+
+
+async def _stream_to_file(url: str, headers: dict, part: Path,
+                          throttle: Callable[[int], Awaitable] = None
+                          ) -> tuple[httpx.Response, str, str, int]:
+    """
+    stream the body of url into part chunk by chunk
+
+    a partial download left by an earlier try is continued with a Range
+    request, validated by If-Range against its ETag/Last-Modified. Hashing
+    and writing run in a thread, WRITE_SIZE bytes at a time.
+
+    :return: response, mime sniffed from the first chunk, md5 of the whole
+        body and its expected length; all but the response are None when
+        no body was saved
+    :raise RangeMismatchError: a 206 whose Content-Range does not continue
+        part, which has to be downloaded again
+    """
+    state = _load_part_state(part, url)
+    offset = part.stat().st_size if state else 0
+    if offset:
+        headers = headers | {
+            'Range': f'bytes={offset}-',
+            'If-Range': state['etag'] or state['last_modified']}
+    async with cdn_client().stream('GET', url, headers=headers) as r:
+        if r.status_code == 416 and offset == state.get('length'):
+            # finished by an earlier try which stopped before renaming it
+            md5 = await asyncio.to_thread(_md5_of, part)
+            return r, state['mime'], md5.hexdigest(), offset
+        if r.status_code == 206:
+            total = _content_range_total(r, offset)
+        elif r.status_code == 200:
+            offset, total = 0, int(r.headers['Content-Length'])
+        else:
+            return r, None, None, None
+        if offset:
+            if total != state['length']:
+                raise RangeMismatchError(
+                    f'{part.name}: {total} bytes in Content-Range, '
+                    f'{state["length"]} expected')
+            mode, mime = 'ab', state['mime']
+            md5 = await asyncio.to_thread(_md5_of, part)
+            console.log(f'resuming {part.name} from {offset} bytes')
+        else:
+            mode, mime, md5 = 'wb', None, hashlib.md5()
+            state = {'url': url,
+                     'etag': r.headers.get('ETag'),
+                     'last_modified': r.headers.get('Last-Modified'),
+                     'length': total,
+                     'mime': None}
+        f = await asyncio.to_thread(part.open, mode)
+        buffer, buffered = [], 0
+        try:
+            async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                if mime is None:
+                    mime = state['mime'] = mime_detector().from_buffer(chunk)
+                    await asyncio.to_thread(
+                        _part_state_file(part).write_text, json.dumps(state))
+                buffer.append(chunk)
+                if (buffered := buffered + len(chunk)) >= WRITE_SIZE:
+                    await asyncio.to_thread(_append, f, md5, buffer)
+                    buffer, buffered = [], 0
+                if throttle:
+                    await throttle(len(chunk))
+        finally:
+            # what arrived before an error is kept for resuming
+            await asyncio.to_thread(_append, f, md5, buffer)
+            await asyncio.to_thread(f.close)
+    return r, mime, md5.hexdigest(), state['length']
+
+
+def _content_range_total(r: httpx.Response, offset: int) -> int:
+    """
+    full length of a 206 to a request for the bytes from offset on
+
+    :raise RangeMismatchError: the range does not start at offset or does
+        not run to the end
+    """
+    content_range = r.headers.get('Content-Range', '')
+    if not (m := re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', content_range)):
+        raise RangeMismatchError(f'unexpected Content-Range {content_range!r}')
+    start, end, total = map(int, m.groups())
+    if start != offset or end != total - 1:
+        raise RangeMismatchError(
+            f'Content-Range {content_range!r} does not continue from {offset}')
+    return total
+
+
+def _append(f, md5, chunks: list[bytes]) -> None:
+    for chunk in chunks:
+        md5.update(chunk)
+        f.write(chunk)
 
 
 def logsaver_decorator(func):
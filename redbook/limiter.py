@@ -0,0 +1,161 @@
+"""
+Per-endpoint token buckets with AIMD backoff for the xiaohongshu api
+
+Every endpoint gets its own budget. A successful request nudges the rate up
+additively, a 461/302/406 halves it and drains the bucket, other statuses
+leave it alone. Buckets use wall clock time so that their state can be
+persisted and restored across runs, they start empty so that a restart does
+not burst.
+"""
+import atexit
+import time
+from typing import Protocol
+
+from toolkit.tool import asleep
+
+from redbook import console
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 3,
+                 min_rate: float = None, max_rate: float = None,
+                 step: float = None,
+                 tokens: float = None, updated_at: float = None) -> None:
+        """
+        :param rate: tokens per second
+        :param capacity: max burst size
+        :param step: additive increase of rate per successful request
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate or rate / 8
+        self.max_rate = max_rate or rate * 4
+        self.step = step or rate / 50
+        self.tokens = 0 if tokens is None else tokens
+        self.updated_at = updated_at or time.time()
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(now - self.updated_at, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float = None) -> float:
+        """seconds until one token is available"""
+        self._refill(now or time.time())
+        return max(1 - self.tokens, 0) / self.rate
+
+    def take(self, now: float = None, amount: float = 1) -> None:
+        self._refill(now or time.time())
+        self.tokens -= amount
+
+    def increase(self) -> None:
+        self.rate = min(self.rate + self.step, self.max_rate)
+
+    def decrease(self) -> None:
+        self.rate = max(self.rate / 2, self.min_rate)
+        self.tokens = min(self.tokens, 0)
+
+    def state(self) -> dict:
+        return {'rate': self.rate, 'tokens': self.tokens,
+                'updated_at': self.updated_at}
+
+    def restore(self, state: dict) -> None:
+        self.rate = min(max(state['rate'], self.min_rate), self.max_rate)
+        self.tokens = min(state['tokens'], self.capacity)
+        self.updated_at = state['updated_at']
+        # tokens saved before the restart are not spent in a burst, a debt
+        # is still paid off
+        self._refill(time.time())
+        self.tokens = min(self.tokens, 0)
+
+
+class BudgetStore(Protocol):
+    def load_budgets(self) -> dict[str, dict]: ...
+    def save_budget(self, endpoint: str, state: dict) -> None: ...
+
+
+# requests per second each endpoint starts from
+BUDGETS = {
+    'user_posted': 1 / 10,
+    'feed': 1 / 10,
+    'otherinfo': 1 / 15,
+    'short_url': 1 / 20,
+    'default': 1 / 10,
+}
+BACKOFF_STATUS = (461, 302, 406)
+# seconds between writes of a bucket to the store, backoffs are written at once
+SAVE_INTERVAL = 60
+
+
+class RateLimiter:
+    def __init__(self, budgets: dict[str, float] = None,
+                 store: BudgetStore = None, prefix: str = '') -> None:
+        """
+        :param prefix: prepended to endpoint names in the store, so that
+            several accounts can persist their budgets side by side
+        """
+        budgets = budgets or BUDGETS
+        self.prefix = prefix
+        self.buckets = {k: TokenBucket(v) for k, v in budgets.items()}
+        self.store = store
+        self._loaded = False
+        self._saved_at: dict[str, float] = {}
+        self._dirty: set[str] = set()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        return url.split('?')[0].rstrip('/').rsplit('/', maxsplit=1)[-1]
+
+    def bucket(self, url: str) -> tuple[str, TokenBucket]:
+        if (name := self.endpoint(url)) not in self.buckets:
+            name = 'default'
+        return name, self.buckets[name]
+
+    def _load(self) -> None:
+        self._loaded = True
+        if not self.store:
+            return
+        for name, state in self.store.load_budgets().items():
+            if not name.startswith(self.prefix):
+                continue
+            if bucket := self.buckets.get(name.removeprefix(self.prefix)):
+                bucket.restore(state)
+
+    def _save(self, name: str, force: bool = False) -> None:
+        if not self.store:
+            return
+        self._dirty.add(name)
+        now = time.time()
+        if force or now - self._saved_at.get(name, 0) >= SAVE_INTERVAL:
+            self.store.save_budget(
+                self.prefix + name, self.buckets[name].state())
+            self._saved_at[name] = now
+            self._dirty.discard(name)
+
+    def flush(self) -> None:
+        """write the buckets changed since their last save"""
+        for name in list(self._dirty):
+            self._save(name, force=True)
+
+    async def acquire(self, url: str) -> None:
+        if not self._loaded:
+            self._load()
+        name, bucket = self.bucket(url)
+        while (wait_time := bucket.wait_time()) > 0:
+            console.log(f'sleep {wait_time:.1f} seconds for {name}...'
+                        f'(rate: {bucket.rate * 3600:.0f}/h)', style='info')
+            await asleep(wait_time)
+        bucket.take()
+        self._save(name)
+
+    def feedback(self, url: str, status_code: int = 200) -> None:
+        name, bucket = self.bucket(url)
+        if status_code in BACKOFF_STATUS:
+            bucket.decrease()
+            console.log(f'{status_code} on {name}, backing off to '
+                        f'{bucket.rate * 3600:.0f}/h', style='error')
+            self._save(name, force=True)
+        elif 200 <= status_code < 300:
+            bucket.increase()
+            self._save(name)
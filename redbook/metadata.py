@@ -0,0 +1,138 @@
+"""
+XMP writing through a pool of ``-stay_open`` exiftool processes
+
+Jobs are queued from the download coroutines and picked up in batches by
+worker tasks, each owning one exiftool and running it in a thread so the
+event loop never waits on exiftool.
+"""
+import asyncio
+import time
+from pathlib import Path
+
+from exiftool import ExifToolHelper
+
+from redbook import console
+
+XMP_PARAMS = ['-overwrite_original', '-ignoreMinorErrors', '-escapeHTML']
+
+
+def fix_suffix(img: Path, ext: str) -> Path:
+    """rename img when exiftool disagrees with its suffix"""
+    if (suffix := f'.{ext.lower()}') != img.suffix:
+        new_img = img.with_suffix(suffix)
+        console.log(
+            f'{img}: suffix is not right, moving to {new_img}...',
+            style='error')
+        img = img.rename(new_img)
+    return img
+
+
+def escape_tags(tags: dict) -> dict:
+    return {k: v.replace('\n', '&#x0a;') if isinstance(v, str) else v
+            for k, v in tags.items()}
+
+
+class XmpWriter:
+    def __init__(self, size: int = 3, batch_size: int = 16) -> None:
+        self.size = size
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self.busy = 0.0
+        self._queue: asyncio.Queue = None
+        self._workers: list[asyncio.Task] = []
+        self._exiftools: list[ExifToolHelper] = []
+        self._loop = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def __str__(self) -> str:
+        per_file = self.busy / (self.written or 1) * 1000
+        return (f'{self.written} files in {self.batches} batches, '
+                f'{per_file:.0f}ms/file, queue depth {self.depth}')
+
+    def _start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        while len(self._exiftools) < self.size:
+            self._exiftools.append(ExifToolHelper())
+        self._workers = [asyncio.create_task(self._work(et))
+                         for et in self._exiftools]
+
+    async def write(self, img: Path, tags: dict, reset: bool = False) -> Path:
+        """
+        write tags to img, fixing its suffix first if needed
+
+        :param reset: drop the xmp img already carries before writing
+
+        :return: the final path of img
+        """
+        if self._loop is not asyncio.get_running_loop():
+            self._start()
+        future = self._loop.create_future()
+        params = ['-XMP:all=', *XMP_PARAMS] if reset else XMP_PARAMS
+        await self._queue.put((img, escape_tags(tags), params, future))
+        return await future
+
+    async def _work(self, et: ExifToolHelper) -> None:
+        while True:
+            jobs = [await self._queue.get()]
+            while len(jobs) < self.batch_size and not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+            start = time.perf_counter()
+            try:
+                results = await asyncio.to_thread(self._write_batch, et, jobs)
+            except Exception as e:
+                results = [e] * len(jobs)
+            self.busy += time.perf_counter() - start
+            self.batches += 1
+            for (*_, future), result in zip(jobs, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    self.written += 1
+                    future.set_result(result)
+
+    @staticmethod
+    def _file_types(et: ExifToolHelper, imgs: list[Path]) -> dict:
+        """
+        FileTypeExtension of each img, or the error reading it
+
+        one exiftool call covers the batch; when it fails, which happens for
+        the whole batch if one file is broken, each file is asked alone
+        """
+        tag = 'File:FileTypeExtension'
+        try:
+            found = et.get_tags(imgs, tag)
+        except Exception:
+            found = []
+            for img in imgs:
+                try:
+                    found += et.get_tags(img, tag)
+                except Exception as e:
+                    found.append({'SourceFile': str(img), tag: e})
+        return {d['SourceFile']: d.get(tag) for d in found}
+
+    @classmethod
+    def _write_batch(cls, et: ExifToolHelper, jobs: list) -> list:
+        exts = cls._file_types(et, [img for img, *_ in jobs])
+        results = []
+        for img, tags, params, _ in jobs:
+            try:
+                if isinstance(ext := exts.get(str(img)), Exception):
+                    raise ext
+                if ext is None:
+                    raise ValueError(f'{img}: exiftool found no file type')
+                img = fix_suffix(img, ext)
+                et.set_tags(img, tags, params=params)
+                results.append(img)
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+xmp_writer = XmpWriter()
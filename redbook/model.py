@@ -1,11 +1,17 @@
+import json
 import re
+from functools import cache
 from pathlib import Path
 from typing import AsyncGenerator, Iterator, Self
 
 import pendulum
+from peewee import (
+    SQL, BigIntegerField, Case, Cast, NodeList,
+    PostgresqlDatabase, ValuesList, fn
+)
 from photosinfo.model import GirlSearch
-from playhouse.shortcuts import model_to_dict, update_model_from_dict
-from rich.prompt import Confirm
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.shortcuts import model_to_dict
 from toolkit.model import (
     ArrayField, BooleanField,
     DateTimeTZField,
@@ -17,11 +23,13 @@ from toolkit.model import (
 
 from redbook import console
 from redbook.exception import UserNotFoundError
+from redbook.fetcher import fetcher
 from redbook.helper import (
-    SAVE_PATH, download_files,
+    SAVE_PATH, confirm, download_file_pair,
     download_single_file,
     normalize_count
 )
+from redbook.pipeline import Pipeline, Stage
 from redbook.redbook import (
     get_note, get_user,
     get_user_notes,
@@ -31,6 +39,21 @@ from redbook.redbook import (
 BaseModel = get_base_model()
 database = get_database('redbook')
 BaseModel.bind(database)
+POST_WINDOW = pendulum.Duration(days=30)
+# a user is due for fetching once this many new notes are estimated
+DUE_POSTS = 4
+# workers and queue bounds of the fetch_note pipeline
+DETAIL_WORKERS = 2
+DOWNLOAD_WORKERS = 16
+NOTE_QUEUE_SIZE = 8
+MEDIA_QUEUE_SIZE = 64
+# changed xsec_tokens written per batch while listing
+XSEC_BATCH_SIZE = 100
+
+
+def post_cycle(count: int) -> int:
+    """hours between posts, from the count of notes in POST_WINDOW"""
+    return (POST_WINDOW / (count + 1)).in_hours()
 
 
 class User(BaseModel):
@@ -59,7 +82,6 @@ class User(BaseModel):
     added_at = DateTimeTZField(null=True, default=pendulum.now)
     redirect = TextField(null=True)
     account_deleted = BooleanField(default=False)
-    search_results = GirlSearch.get_search_results()['red']
 
     @classmethod
     async def from_id(cls, user_id: str, update=False) -> Self:
@@ -77,8 +99,7 @@ class User(BaseModel):
                 if not model or user_dict['following'] == model.following:
                     break
             else:
-                console.log(model)
-                if not Confirm.ask('following status changed?'):
+                if not await confirm('following status changed?', model):
                     raise ValueError('following status changed!')
             await cls.upsert(user_dict)
         model = cls.get_by_id(user_id)
@@ -89,7 +110,7 @@ class User(BaseModel):
     async def upsert(cls, user_dict: dict):
         user_id = user_dict['id']
         if not (model := cls.get_or_none(id=user_id)):
-            if not (username := cls.search_results.get(user_id)):
+            if not (username := red_search_results().get(user_id)):
                 username = user_dict['nickname'].strip('-_ ')
             assert username
             user_dict['username'] = username
@@ -168,6 +189,11 @@ class UserConfig(BaseModel):
     folder = TextField(null=True)
     added_at = DateTimeTZField(null=True, default=pendulum.now)
     homepage = TextField()
+    # timestamps of the notes posted within POST_WINDOW, kept up to date
+    # together with notes_count and post_at by record_post
+    recent_posts = ArrayField(field_class=BigIntegerField, null=True)
+    # when the estimated new notes reach DUE_POSTS, see fetch_schedule
+    next_fetch_at = DateTimeTZField(null=True, index=True)
 
     @classmethod
     async def from_id(cls, user_id: int) -> Self:
@@ -180,9 +206,12 @@ class UserConfig(BaseModel):
             cls.update(to_insert).where(cls.user_id == user_id).execute()
         else:
             cls.insert(to_insert).execute()
+            # the user's notes may already be stored, e.g. the config
+            # was deleted and is being re-created
+            cls.rebuild_stats([user_id])
         if user.account_deleted:
-            console.log(config)
-            if not Confirm.ask('seems account deleted, disable fetch?'):
+            if not await confirm(
+                    'seems account deleted, disable fetch?', config):
                 raise ValueError('账号已注销')
             config.note_fetch = False
             config.save()
@@ -204,24 +233,122 @@ class UserConfig(BaseModel):
             yield note
 
     def get_post_cycle(self) -> int:
-        interval = pendulum.Duration(days=30)
-        start, end = self.note_fetch_at-interval, self.note_fetch_at
-        count = self.user.notes.where(Note.time.between(start, end)).count()
-        cycle = interval / (count + 1)
-        return cycle.in_hours()
+        end = self.note_fetch_at.int_timestamp
+        start = end - POST_WINDOW.in_seconds()
+        count = sum(start <= t <= end for t in self.recent_posts or [])
+        return post_cycle(count)
+
+    def schedule(self):
+        """set next_fetch_at from note_fetch_at and post_cycle"""
+        self.next_fetch_at = self.note_fetch_at.add(
+            hours=DUE_POSTS * self.post_cycle)
+
+    @classmethod
+    def schedule_all(cls):
+        configs = list(cls.select(cls.id, cls.note_fetch_at, cls.post_cycle)
+                       .where(cls.note_fetch_at.is_null(False),
+                              cls.post_cycle.is_null(False)))
+        for config in configs:
+            config.schedule()
+        with database.atomic():
+            cls.bulk_update(configs, [cls.next_fetch_at], batch_size=500)
+
+    @classmethod
+    def record_post(cls, user_id: str, time: pendulum.DateTime):
+        """
+        update the post statistics of user for a newly inserted note, in
+        one statement so concurrent inserts do not lose each other's counts
+        """
+        horizon = pendulum.now().int_timestamp - POST_WINDOW.in_seconds()
+        posted = fn.array_append(cls.recent_posts,
+                                 Cast(int(time.timestamp()), 'bigint'))
+        recent_posts = NodeList([
+            SQL('ARRAY(SELECT t FROM unnest('), posted,
+            SQL(') t WHERE t >'), horizon, SQL('ORDER BY t)')])
+        cls.update({
+            cls.notes_count: cls.notes_count + 1,
+            cls.post_at: fn.GREATEST(cls.post_at, cls.post_at.to_value(time)),
+            cls.recent_posts: recent_posts,
+        }).where(cls.user == user_id).execute()
+
+    @classmethod
+    def rebuild_stats(cls, user_ids: list[str] = None):
+        """
+        recompute notes_count, post_at and recent_posts from notes
+
+        :param user_ids: only the configs of these users
+        """
+        stats = Note.select(Note.user, fn.COUNT(Note.id), fn.MAX(Note.time))
+        configs = cls.select(cls.id, cls.user)
+        if user_ids is not None:
+            stats = stats.where(Note.user.in_(user_ids))
+            configs = configs.where(cls.user.in_(user_ids))
+        stats = {user_id: (count, latest) for user_id, count, latest
+                 in stats.group_by(Note.user).tuples()}
+        configs = list(configs)
+        now = pendulum.now()
+        recent = cls._window_posts({c.user_id: now for c in configs})
+        for config in configs:
+            config.notes_count, config.post_at = stats.get(
+                config.user_id, (0, None))
+            config.recent_posts = sorted(recent.get(config.user_id, []))
+        with database.atomic():
+            cls.bulk_update(configs, [cls.notes_count, cls.post_at,
+                                      cls.recent_posts], batch_size=500)
 
     @classmethod
     def update_table(cls):
+        """
+        refresh photos_num and folder of every config with a fixed number
+        of queries, writing only the rows that changed
+
+        post statistics are kept up to date as notes are inserted, see
+        record_post
+        """
         from photosinfo.model import Girl
-        for config in UserConfig.select():
-            if girl := Girl.get_or_none(red_id=config.user_id):
+        girls = {g.red_id: g for g in Girl.select(
+            Girl.red_id, Girl.red_num, Girl.folder).where(
+            Girl.red_id.is_null(False))}
+        configs = list(cls.select(
+            cls.id, cls.user, cls.photos_num, cls.folder))
+        changed = []
+        for config in configs:
+            old = (config.photos_num, config.folder)
+            if girl := girls.get(config.user_id):
                 config.photos_num = girl.red_num
                 config.folder = girl.folder
             else:
                 config.photos_num = 0
-            if config.note_fetch_at:
-                config.post_cycle = config.get_post_cycle()
-            config.save()
+            if old != (config.photos_num, config.folder):
+                changed.append(config)
+        with database.atomic():
+            cls.bulk_update(changed, [cls.photos_num, cls.folder],
+                            batch_size=500)
+
+    @staticmethod
+    def _window_posts(ends: dict[str, pendulum.DateTime]
+                      ) -> dict[str, list[int]]:
+        """
+        timestamps of the notes posted in the POST_WINDOW ending at ends[user_id]
+
+        one query per 5000 users, the windows are joined as a VALUES CTE
+        """
+        posts = {}
+        ends = list(ends.items())
+        for i in range(0, len(ends), 5000):
+            windows = ValuesList(
+                [(user_id, Note.time.db_value(end - POST_WINDOW),
+                  Note.time.db_value(end))
+                 for user_id, end in ends[i:i+5000]]
+            ).cte('w', columns=('user_id', 'start', 'end'))
+            query = (Note.select(Note.user, Note.time)
+                     .join(windows, on=(
+                         (Note.user == windows.c.user_id) &
+                         Note.time.between(windows.c.start, windows.c.end)))
+                     .with_cte(windows))
+            for user_id, time in query.tuples():
+                posts.setdefault(user_id, []).append(int(time.timestamp()))
+        return posts
 
     async def fetch_note(self, download_dir: Path):
         refetch = (self.notes_count < 50 or not self.note_refetch_at or
@@ -240,27 +367,28 @@ class UserConfig(BaseModel):
         console.log(f"Media Saving: {download_dir}")
 
         now = pendulum.now()
-        imgs = self._save_notes(download_dir, refetch=refetch)
-        await download_files(imgs)
+        await self._save_notes(download_dir, refetch=refetch)
         console.log(f"{self.username} 📕 获取完毕\n")
 
         self.note_fetch_at = now
-        if notes := self.user.notes.order_by(Note.time.desc()):
-            self.post_at = notes.first().time
+        # notes_count, post_at and recent_posts were kept up to date by
+        # Note.upsert while fetching
+        stats = UserConfig.get_by_id(self.id)
+        self.notes_count = stats.notes_count
+        self.post_at = stats.post_at
+        self.recent_posts = stats.recent_posts
         self.post_cycle = self.get_post_cycle()
+        self.schedule()
         if refetch:
             self.note_refetch_at = now
-        self.notes_count = self.user.notes.count()
         self.save()
 
-    async def _save_notes(
-            self,
-            download_root: Path,
-            refetch=False,
-    ) -> AsyncGenerator[list[dict]]:
+    async def _save_notes(self, download_root: Path, refetch=False):
         """
-        Save note to database and return media info
-        :return: generator of medias to downloads
+        Save notes to database and download their medias
+
+        listing, fetching note details and downloading run as stages of a
+        pipeline, so downloads of one note overlap fetching the next ones
         """
 
         since = self.note_fetch_at or pendulum.from_timestamp(0)
@@ -274,32 +402,73 @@ class UserConfig(BaseModel):
             revisit_dir = download_root / 'Revisit' / self.username
         else:
             revisit_dir = download_dir
+        # the stored notes and their caches, loaded once instead of
+        # queried per note by the listing and Note.from_id
+        known = {n.id: n for n in Note.select().where(
+            Note.user == self.user_id)}
+        caches = {c.id: c for c in Cache.select().where(
+            Cache.id.in_(Note.select(Note.id).where(
+                Note.user == self.user_id)))}
+        skip = Media.done_paths(user_id=self.user_id)
+        resumed = []
         if self.is_caching:
             console.log(f'caching notes from {since:%Y-%m-%d}\n')
         else:
             console.log(f'fetch notes from {since:%Y-%m-%d}\n')
+            for medias in Media.pending(self.user_id):
+                console.log(f'resuming {medias[0]["filename"]}...')
+                skip.update(map(_media_path, medias))
+                resumed.append(medias)
         note_time_order, note_ids = [], []
-        async for note_info in self.page():
-            update_xsec_token(note_info['id'], note_info['xsec_token'])
-            sticky = note_info.pop('sticky')
-            cached = Cache.get_or_none(id=note_info['id'])
-            if note := Note.get_or_none(id=note_info['id']):
-                if note.time < since and (cached or not self.is_caching):
-                    if sticky:
-                        console.log("略过置顶笔记...")
-                        continue
-                    if refetch or note.time > since.subtract(months=1):
-                        continue
-                    console.log(
-                        f"时间 {note.time:%y-%m-%d} 在 {since:%y-%m-%d}之前, "
-                        "获取完毕")
-                    break
 
-            has_fetched = note
+        async def list_notes():
+            index, tokens = 0, {}
+            try:
+                async for note_info in self.page():
+                    note_id = note_info['id']
+                    sticky = note_info.pop('sticky')
+                    cached = note_id in caches
+                    if note := known.get(note_id):
+                        if note.xsec_token != (
+                                token := note_info['xsec_token']):
+                            tokens[note_id] = token
+                            # the preloaded rows Note.from_id works on
+                            # carry the new token too
+                            note.xsec_token = token
+                            note.url = note_url(note_id, token)
+                            if cache := caches.get(note_id):
+                                cache.xsec_token = token
+                                cache.note_info |= {'url': note.url,
+                                                    'xsec_token': token}
+                            if len(tokens) >= XSEC_BATCH_SIZE:
+                                update_xsec_tokens(tokens)
+                                tokens = {}
+                        if note.time < since and (
+                                cached or not self.is_caching):
+                            if sticky:
+                                console.log("略过置顶笔记...")
+                                continue
+                            if refetch or note.time > since.subtract(
+                                    months=1):
+                                continue
+                            console.log(
+                                f"时间 {note.time:%y-%m-%d} 在 "
+                                f"{since:%y-%m-%d}之前, 获取完毕")
+                            return
+                    yield index, note_info, sticky, cached, note
+                    index += 1
+            finally:
+                # the pipeline closes the listing when it stops, so the
+                # rest is written on cancellation and errors as well
+                update_xsec_tokens(tokens)
+
+        async def fetch_detail(item) -> list[list[dict]]:
+            index, note_info, sticky, cached, has_fetched = item
             note = await Note.from_id(
                 note_info['id'],
                 xsec_token=note_info['xsec_token'],
-                update=not cached)
+                update=not cached, user=self.user,
+                stored=(has_fetched, caches.get(note_info['id'])))
             if note.time < since and not has_fetched:
                 console.log(
                     f'find note {note.id} before {since:%y-%m-%d} '
@@ -319,47 +488,82 @@ class UserConfig(BaseModel):
                 if getattr(note, k) != v:
                     assert k in ['liked_count', 'xsec_token', 'liked']
             if not sticky:
-                note_time_order.append(note.time)
+                note_time_order.append((index, note.time))
             note_ids.append(note.id)
 
-            medias = list(note.medias(save_path))
             console.log(note.url, style=f"link {note.url}")
             console.log(note, '\n')
             if self.is_caching:
-                continue
+                return
+            medias = note.pending_medias(save_path, skip)
             console.log(
                 f"Downloading {len(medias)} files to {save_path}..")
             console.print()
-            for media in medias:
-                yield media
-        if note_time_order:
-            console.log(f'{len(note_time_order)} notes fetched')
-            assert sorted(note_time_order, reverse=True) == note_time_order
-        if self.is_caching:
-            return
-        query = self.user.notes.where(
-            Note.id.not_in(note_ids)).where(Note.time > since)
-        for note in query:
-            console.log(f'find invisible note {note.id}', style='notice')
-            medias = list(note.medias(download_dir))
-            console.log(note)
-            console.log(
-                f"Downloading {len(medias)} files to {download_dir}..")
-            console.print()
-            for media in medias:
-                yield media
+            return medias
+
+        async def find_invisible() -> list[list[dict]]:
+            if note_time_order:
+                console.log(f'{len(note_time_order)} notes fetched')
+                times = [t for _, t in sorted(note_time_order)]
+                assert sorted(times, reverse=True) == times
+            if self.is_caching:
+                return []
+            query = self.user.notes.where(
+                Note.id.not_in(note_ids)).where(Note.time > since)
+            groups = []
+            for note in query:
+                console.log(f'find invisible note {note.id}', style='notice')
+                medias = note.pending_medias(download_dir, skip)
+                console.log(note)
+                console.log(
+                    f"Downloading {len(medias)} files to {download_dir}..")
+                console.print()
+                groups += medias
+            return groups
+
+        async def download(medias: list[dict]) -> None:
+            Media.mark_done(medias, await download_file_pair(medias))
+
+        downloads = Stage('download', download,
+                          DOWNLOAD_WORKERS, MEDIA_QUEUE_SIZE)
+        pipeline = Pipeline(
+            list_notes(),
+            Stage('detail', fetch_detail, DETAIL_WORKERS, NOTE_QUEUE_SIZE,
+                  flush=find_invisible),
+            downloads)
+        pipeline.seed(downloads, resumed)
+        try:
+            await pipeline.run()
+        finally:
+            console.log(f'pipeline: {pipeline}')
+
+
+def note_url(note_id: str, xsec_token: str) -> str:
+    return (f'https://xiaohongshu.com/explore/{note_id}'
+            f'?xsec_token={xsec_token}&xsec_source=pc_user')
 
 
-def update_xsec_token(note_id, xsec_token):
-    url = f'https://xiaohongshu.com/explore/{note_id}?xsec_token={xsec_token}&xsec_source=pc_user'
-    if cache := Cache.get_or_none(id=note_id):
-        cache.xsec_token = xsec_token
-        cache.note_info |= {'url': url, 'xsec_token': xsec_token}
-        cache.save()
-    if note := Note.get_or_none(id=note_id):
-        note.xsec_token = xsec_token
-        note.url = url
-        note.save()
+def update_xsec_tokens(tokens: dict[str, str]):
+    """write the xsec_token (and url) of many notes and their caches"""
+    if not tokens:
+        return
+    notes = [Note(id=i, xsec_token=t, url=note_url(i, t))
+             for i, t in tokens.items()]
+    caches = []
+    for cache in Cache.select().where(Cache.id.in_(list(tokens))):
+        token = tokens[cache.id]
+        cache.note_info |= {'url': note_url(cache.id, token),
+                            'xsec_token': token}
+        caches.append({'id': cache.id, 'xsec_token': token,
+                       'note_info': cache.note_info,
+                       'added_at': cache.added_at})
+    with database.atomic():
+        Note.bulk_update(notes, [Note.xsec_token, Note.url], batch_size=100)
+        if caches:
+            (Cache.insert_many(caches)
+             .on_conflict(conflict_target=[Cache.id],
+                          preserve=[Cache.xsec_token, Cache.note_info])
+             .execute())
 
 
 class Cache(BaseModel):
@@ -371,16 +575,14 @@ class Cache(BaseModel):
 
     @classmethod
     def upsert(cls, note_info: dict) -> Self:
-        d = {'id': (id := note_info['note_id']),
-             'xsec_token': note_info['xsec_token'],
-             'note_info': note_info}
-        if cache := cls.get_or_none(id=id):
-            d['updated_at'] = pendulum.now()
-            update_model_from_dict(cache, d)
-            cache.save()
-        else:
-            d['added_at'] = pendulum.now()
-            cls.insert(d).execute()
+        now = pendulum.now()
+        (cls.insert(id=(id := note_info['note_id']),
+                    xsec_token=note_info['xsec_token'],
+                    note_info=note_info, added_at=now)
+         .on_conflict(conflict_target=[cls.id],
+                      preserve=[cls.xsec_token, cls.note_info],
+                      update={cls.updated_at: now})
+         .execute())
         return cls.get_by_id(id)
 
     def parse(self) -> dict:
@@ -416,66 +618,112 @@ class Note(BaseModel):
     xsec_token = TextField(null=True)
 
     @classmethod
-    async def from_id(cls, note_id, update: bool = False, xsec_token: str = '') -> Self:
-        note = cls.get_or_none(id=note_id)
-        cache = Cache.get_or_none(id=note_id)
-        if update or not (note or cache):
+    async def from_id(cls, note_id, update: bool = False, xsec_token: str = '',
+                      user: User = None,
+                      stored: tuple[Self | None, 'Cache | None'] = None
+                      ) -> Self:
+        """
+        :param user: owner of the note if the caller has it at hand
+        :param stored: the note and cache rows, None where missing, if the
+            caller loaded them already
+        """
+        if stored:
+            note, cache = stored
+        else:
+            note = cls.get_or_none(id=note_id)
+            cache = Cache.get_or_none(id=note_id)
+        if fetched := update or not (note or cache):
             note_info = await get_note(note_id, xsec_token or note.xsec_token)
             cache = Cache.upsert(note_info)
         elif cache:
             note_info = cache.note_info
         else:
             return note
-        note_dict = parse_note(note_info)
+        # payloads seen for the first time are checked for api changes
+        note_dict = parse_note(note_info, strict=fetched)
         note_dict = {k: v for k, v in note_dict.items() if v != []}
-        user: User = User.get_by_id(note_dict['user_id'])
+        if not user or user.id != note_dict['user_id']:
+            user = User.get_by_id(note_dict['user_id'])
         assert note_dict.pop('nickname') == user.nickname
         assert note_dict['following'] == user.following
         note_dict['username'] = user.username
         assert 'added_at' not in note_dict
         assert 'updated_at' not in note_dict
         note_dict['updated_at'] = cache.updated_at or cache.added_at
-        await cls.upsert(note_dict)
-        return cls.get_by_id(note_id)
+        await cls.upsert(note_dict, model=note)
+        if not note:
+            return cls.get_by_id(note_id)
+        for key, value in note_dict.items():
+            setattr(note, key, value)
+        return note
 
     @classmethod
-    async def upsert(cls, note_dict):
+    async def upsert(cls, note_dict, model: Self = None):
+        """
+        :param model: the stored note, when the caller loaded it already
+        """
         note_id = note_dict['id']
-        if not (model := cls.get_or_none(id=note_id)):
+        if not (model := model or cls.get_or_none(id=note_id)):
             note_dict['added_at'] = note_dict.pop('updated_at')
             try:
-                return cls.insert(note_dict).execute()
+                inserted = cls.insert(note_dict).execute()
             except Exception:
                 url = note_dict['url']
                 console.log(url, style=f'link {url}')
                 console.log(
                     f'{url} insert to database failed', style='error')
                 raise
+            UserConfig.record_post(note_dict['user_id'], note_dict['time'])
+            return inserted
         model_dict = model_to_dict(model, recurse=False)
         model_dict['user_id'] = model_dict.pop('user')
 
+        changed = False
         for key, value in note_dict.items():
             assert value or value == 0
             if (ori := model_dict[key]) == value:
                 continue
+            changed = True
             if key in ['xsec_token', 'url', 'updated_at',
                        'following', 'liked_count', 'share_count',
                        'comment_count', 'collected_count']:
                 continue
-            if key in ['pic_ids', 'pics', 'video', 'video_md5']:
-                assert note_dict['last_update_time'] >= model.last_update_time, (
-                    note_dict['last_update_time'], model.last_update_time)
-            if key in ['pics', 'pic_ids']:
-                assert set(v.split()[0].split('/')[-1]
-                           for v in value) == set(v.split()[0].split('/')[-1] for v in ori)
+            cls.check_change(key, model_dict, note_dict)
 
             console.log(f'+{key}: {value}', style='green bold on dark_green')
             if ori is not None:
                 console.log(f'-{key}: {ori}', style='red bold on dark_red')
+        if not changed:
+            return 0
         return cls.update(note_dict).where(cls.id == note_id).execute()
 
+    @staticmethod
+    def check_change(key: str, old: dict, new: dict):
+        """
+        raise AssertionError when changing key from old to new breaks what
+        a stored note keeps: its medias only change along with
+        last_update_time, and never to other images
+        """
+        if key in ['pic_ids', 'pics', 'video', 'video_md5']:
+            assert new['last_update_time'] >= old['last_update_time'], (
+                new['last_update_time'], old['last_update_time'])
+        if key in ['pics', 'pic_ids']:
+            assert set(v.split()[0].split('/')[-1]
+                       for v in new[key]) == set(v.split()[0].split('/')[-1] for v in old[key])
+
+    def delete_instance(self, *args, **kwargs):
+        """delete the note and take it out of its user's post statistics"""
+        deleted = super().delete_instance(*args, **kwargs)
+        UserConfig.rebuild_stats([self.user_id])
+        return deleted
+
+    @property
+    def media_prefix(self) -> str:
+        """what the file names of the medias of this version start with"""
+        return f'{self.last_update_time:%y-%m-%d}_{self.username}_{self.id}'
+
     def medias(self, filepath: Path = None) -> Iterator[list[dict]]:
-        prefix = f'{self.last_update_time:%y-%m-%d}_{self.username}_{self.id}'
+        prefix = self.media_prefix
         if self.video:
             if len(self.pics) == 1:
                 yield [{
@@ -483,10 +731,12 @@ class Note(BaseModel):
                     'filename': f'{prefix}.mp4',
                     'filepath': filepath,
                     'xmp_info': self.gen_meta(url=self.video),
+                    'key': self.video,
                 }]
                 return
             assert len(self.pics) > 1  # video is a set of imgs
-        for sn, url in enumerate(self.pics, start=1):
+        for sn, (url, pic_id) in enumerate(
+                zip(self.pics, self.pic_ids), start=1):
             if ' ' not in url:
                 url += ' '
             url, live = url.split(' ')
@@ -497,6 +747,7 @@ class Note(BaseModel):
                 'filename': f'{prefix}_{sn}{live_tag}_img{suffix}',
                 'filepath': filepath,
                 'xmp_info': self.gen_meta(sn=sn, url=url),
+                'key': f'{pic_id}{live_tag}',
             }]
             if live:
                 meta.append({
@@ -504,9 +755,28 @@ class Note(BaseModel):
                     'filename': f'{prefix}_{sn}{live_tag}.mov',
                     'filepath': filepath,
                     'xmp_info': self.gen_meta(sn=sn, url=live),
+                    'key': live.split('?')[0],
                 })
             yield meta
 
+    def pending_medias(self, filepath: Path,
+                       skip: set[str] = None) -> list[list[dict]]:
+        """
+        medias not recorded as downloaded in Media, registered there
+
+        :param skip: paths done or already handed out for download, queried
+            when not given; the returned ones are added to it
+        """
+        if skip is None:
+            skip = Media.done_paths(note_id=self.id)
+        pending = [(sn, medias) for sn, medias in enumerate(
+            self.medias(filepath), start=1)
+            if not all(_media_path(m) in skip for m in medias)]
+        Media.register(self.id, pending, self.media_prefix)
+        for _, medias in pending:
+            skip.update(map(_media_path, medias))
+        return [medias for _, medias in pending]
+
     def gen_meta(self, sn: str | int = '', url: str = "") -> dict:
         if (pic_num := len(self.pics)) == 1:
             assert not sn or int(sn) == 1
@@ -593,5 +863,182 @@ class Artist(BaseModel):
         return {"XMP:" + k: v for k, v in xmp.items()}
 
 
-database.create_tables(
-    [User, UserConfig, Note, Artist, Cache])
+def _media_path(media: dict) -> str:
+    return str(media['filepath'] / media['filename'])
+
+
+class Media(BaseModel):
+    """
+    manifest of note medias, one row per file to save
+
+    rows are registered as pending before downloading and marked done once
+    the file is in place, so an interrupted fetch resumes exactly the
+    pending ones and skip checks are one query per note.
+    """
+    # planned path, the file may end up with another suffix
+    path = TextField(primary_key=True, unique=True)
+    note = ForeignKeyField(Note, backref='media_files')
+    sn = IntegerField()
+    # media_store key: pic_id with its live tag, or the video url
+    key = TextField(null=True)
+    file = TextField(null=True)
+    size = IntegerField(null=True)
+    checksum = TextField(null=True)
+    status = TextField(default='pending')
+    updated_at = DateTimeTZField(default=pendulum.now)
+
+    @classmethod
+    def done_paths(cls, note_id: str = None, user_id: str = None) -> set[str]:
+        query = cls.select(cls.path).where(cls.status == 'done')
+        if note_id:
+            query = query.where(cls.note == note_id)
+        if user_id:
+            query = query.join(Note).where(Note.user == user_id)
+        return {m.path for m in query}
+
+    @classmethod
+    def register(cls, note_id: str, groups: list[tuple[int, list[dict]]],
+                 prefix: str):
+        """
+        record groups as pending, retiring the pending rows of an earlier
+        version of the note: their names carry another media prefix
+
+        :param prefix: Note.media_prefix of the current version
+        """
+        (cls.delete()
+         .where(cls.note == note_id, cls.status == 'pending',
+                ~cls.path.contains(prefix))
+         .execute())
+        rows = [{'path': _media_path(m), 'note': note_id,
+                 'sn': sn, 'key': m.get('key')}
+                for sn, medias in groups for m in medias]
+        if rows:
+            cls.insert_many(rows).on_conflict_ignore().execute()
+
+    @classmethod
+    def mark_done(cls, medias: list[dict], saved: list[tuple[Path, str]]):
+        """one UPDATE for the files of a group, keeping known checksums"""
+        rows = [(_media_path(media), file, checksum)
+                for media, (file, checksum) in zip(medias, saved)]
+        update = {
+            cls.file: Case(cls.path, [(p, str(f)) for p, f, _ in rows]),
+            cls.size: Case(cls.path, [(p, f.stat().st_size)
+                                      for p, f, _ in rows]),
+            cls.status: 'done', cls.updated_at: pendulum.now()}
+        if checksums := [(p, c) for p, _, c in rows if c]:
+            update[cls.checksum] = Case(cls.path, checksums, cls.checksum)
+        cls.update(update).where(cls.path.in_([p for p, *_ in rows])).execute()
+
+    @classmethod
+    def pending(cls, user_id: str) -> Iterator[list[dict]]:
+        """media groups of user left pending by an interrupted fetch"""
+        query = (cls.select(cls.path, Note).join(Note)
+                 .where(Note.user == user_id, cls.status == 'pending'))
+        notes, paths = {}, {}
+        for row in query:
+            notes[row.note.id] = row.note
+            folder = Path(row.path).parent
+            paths.setdefault((row.note.id, folder), set()).add(row.path)
+        for (note_id, folder), pending in paths.items():
+            for medias in notes[note_id].medias(folder):
+                if any(_media_path(m) in pending for m in medias):
+                    yield medias
+
+
+class RateBudget(BaseModel):
+    """persisted token bucket state of fetcher.limiter"""
+    endpoint = TextField(primary_key=True, unique=True)
+    state = JSONField()
+    updated_at = DateTimeTZField(default=pendulum.now)
+
+    @classmethod
+    def load_budgets(cls) -> dict[str, dict]:
+        return {b.endpoint: b.state for b in cls.select()}
+
+    @classmethod
+    def save_budget(cls, endpoint: str, state: dict) -> None:
+        (cls.insert(endpoint=endpoint, state=state, updated_at=pendulum.now())
+         .on_conflict(conflict_target=[cls.endpoint],
+                      preserve=[cls.state, cls.updated_at])
+         .execute())
+
+
+def add_missing_columns(*models) -> set[str]:
+    """
+    add fields declared on models but missing from their tables
+
+    :return: names of the added fields
+    """
+    migrator = SchemaMigrator.from_database(database)
+    added = set()
+    for model in models:
+        table = model._meta.table_name
+        columns = {c.name for c in database.get_columns(table)}
+        fields = [f for f in model._meta.sorted_fields
+                  if f.column_name not in columns]
+        migrate(*[migrator.add_column(table, f.column_name, f)
+                  for f in fields])
+        added.update(f.name for f in fields)
+    return added
+
+
+SEARCH_CACHE = SAVE_PATH / '.girl_search.json'
+
+
+def _search_marker() -> list[int] | None:
+    """
+    row count and newest row version (xmin) of the photosinfo search
+    table: every committed insert or update raises max(xmin) and every
+    delete lowers the count, so the search results cached under the same
+    marker are current
+    """
+    db = GirlSearch._meta.database
+    if not isinstance(db, PostgresqlDatabase):
+        return None
+    row = GirlSearch.select(
+        fn.COUNT(SQL('*')), fn.MAX(SQL('xmin::text::bigint'))).tuples().get()
+    return list(row)
+
+
+@cache
+def red_search_results() -> dict[str, str]:
+    """usernames photosinfo knows, by red user id"""
+    marker = _search_marker()
+    try:
+        cached = json.loads(SEARCH_CACHE.read_text())
+    except (OSError, ValueError):
+        cached = {}
+    if marker is not None and cached.get('marker') == marker:
+        return cached['red']
+    console.log('photosinfo changed, reloading search results...')
+    results = GirlSearch.get_search_results()['red']
+    if marker is not None:
+        tmp = SEARCH_CACHE.with_suffix('.tmp')
+        try:
+            tmp.write_text(json.dumps({'marker': marker, 'red': results}))
+            tmp.replace(SEARCH_CACHE)
+        except OSError as e:
+            console.log(f'failed to cache search results: {e}',
+                        style='error')
+    return results
+
+
+@cache
+def init_database() -> None:
+    """create and migrate the tables, once, before the first query"""
+    database.create_tables(
+        [User, UserConfig, Note, Artist, Cache, Media, RateBudget])
+    table = Media._meta.table_name
+    if 'pic_id' in {c.name for c in database.get_columns(table)}:
+        # Media.key was called pic_id
+        migrate(SchemaMigrator.from_database(database).rename_column(
+            table, 'pic_id', 'key'))
+    added = add_missing_columns(UserConfig)
+    if 'recent_posts' in added:
+        UserConfig.rebuild_stats()
+    if 'next_fetch_at' in added:
+        UserConfig.schedule_all()
+
+
+for f in fetcher.fetchers:
+    f.limiter.store = RateBudget
@@ -0,0 +1,146 @@
+"""
+Async stages connected by bounded queues
+
+Every stage runs its own number of workers. They take items from the
+stage's queue and put what they return on the queue of the next stage. A
+full queue holds back the stage feeding it, so memory stays bounded and the
+pace is set by the slowest stage. Busy time is measured per stage without
+the time spent blocked on queues, which makes the bottleneck the stage
+whose utilization is close to 100%.
+"""
+import asyncio
+import time
+from contextlib import aclosing, nullcontext
+from typing import AsyncIterable, Awaitable, Callable, Iterable
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name: str,
+                 func: Callable[[object], Awaitable[list | None]] = None,
+                 workers: int = 1, maxsize: int = 0,
+                 flush: Callable[[], Awaitable[list]] = None) -> None:
+        """
+        :param func: takes one item, returns the items for the next stage
+        :param maxsize: bound of the queue feeding this stage
+        :param flush: called once every item is processed, returns the
+            last items for the next stage
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.flush = flush
+        self.queue = asyncio.Queue(maxsize)
+        self.processed = 0
+        self.busy = 0.0
+        self.elapsed = 0.0
+        self._producers = 0
+
+    @property
+    def utilization(self) -> float:
+        if not self.elapsed:
+            return 0.0
+        return self.busy / (self.workers * self.elapsed)
+
+    def __str__(self) -> str:
+        bound = self.queue.maxsize or '∞'
+        return (f'{self.name} x{self.workers}: {self.processed} items, '
+                f'{self.utilization:.0%} busy, '
+                f'queue {self.queue.qsize()}/{bound}')
+
+
+class Pipeline:
+    def __init__(self, source: AsyncIterable, *stages: Stage) -> None:
+        """
+        :param source: items for the first stage, metered as 'listing'
+        """
+        self.source = source
+        self.listing = Stage('listing')
+        self.stages = stages
+        self._seeds: list[tuple[Stage, Iterable]] = []
+
+    def __str__(self) -> str:
+        return '; '.join(map(str, [self.listing, *self.stages]))
+
+    def seed(self, stage: Stage, items: Iterable) -> None:
+        """items put on stage besides what the stage before produces"""
+        self._seeds.append((stage, items))
+
+    async def run(self) -> None:
+        start = time.perf_counter()
+        for stage in self.stages:
+            stage._producers = 1
+        for stage, _ in self._seeds:
+            stage._producers += 1
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._produce())
+                for stage, items in self._seeds:
+                    tg.create_task(self._feed(stage, items))
+                for stage, nxt in zip(self.stages, [*self.stages[1:], None]):
+                    tg.create_task(self._run_stage(stage, nxt))
+        except ExceptionGroup as group:
+            # surface the first failure as is, e.g. VerificationError
+            error = group
+            while isinstance(error, ExceptionGroup):
+                error = error.exceptions[0]
+            raise error
+        finally:
+            for stage in [self.listing, *self.stages]:
+                stage.elapsed = time.perf_counter() - start
+
+    async def _close(self, stage: Stage | None) -> None:
+        if stage is None:
+            return
+        stage._producers -= 1
+        if not stage._producers:
+            for _ in range(stage.workers):
+                await stage.queue.put(_DONE)
+
+    async def _feed(self, stage: Stage, items: Iterable) -> None:
+        for item in items:
+            await stage.queue.put(item)
+        await self._close(stage)
+
+    async def _produce(self) -> None:
+        first = self.stages[0]
+        iterator = aiter(self.source)
+        # close an async generator source right here when the pipeline is
+        # cancelled or fails, not whenever it gets garbage collected
+        async with aclosing(iterator) if hasattr(
+                iterator, 'aclose') else nullcontext():
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = await anext(iterator)
+                except StopAsyncIteration:
+                    break
+                finally:
+                    self.listing.busy += time.perf_counter() - start
+                self.listing.processed += 1
+                await first.queue.put(item)
+        await self._close(first)
+
+    async def _run_stage(self, stage: Stage, nxt: Stage | None) -> None:
+        await asyncio.gather(*[self._work(stage, nxt)
+                               for _ in range(stage.workers)])
+        if stage.flush:
+            start = time.perf_counter()
+            items = await stage.flush()
+            stage.busy += time.perf_counter() - start
+            await self._put(nxt, items)
+        await self._close(nxt)
+
+    async def _work(self, stage: Stage, nxt: Stage | None) -> None:
+        while (item := await stage.queue.get()) is not _DONE:
+            start = time.perf_counter()
+            items = await stage.func(item)
+            stage.busy += time.perf_counter() - start
+            stage.processed += 1
+            await self._put(nxt, items)
+
+    @staticmethod
+    async def _put(stage: Stage | None, items: list | None) -> None:
+        for item in items or ():
+            await stage.queue.put(item)
@@ -1,7 +1,6 @@
 import itertools
 import re
 import time
-from copy import deepcopy
 from typing import AsyncIterator
 
 import pendulum
@@ -184,135 +183,185 @@ async def get_note(note_id: str, xsec_token: str = '') -> dict:
     return note
 
 
+# the url a video is fetched from; anything else goes through furl
+_PLAIN_URL = re.compile(r'^(https?)://([a-z0-9.-]+)(/[\w/.~-]*)(?:\?[^#]*)?$',
+                        re.ASCII)
+_VIDEO_HOST = re.compile(r'^sns-video-[a-z0-9]{2}\.xhscdn\.com$')
+_WEBPIC_URL = re.compile(
+    r'^https?://sns-webpic-qc\.xhscdn\.com/\d{12}/[a-f0-9]{32}/(.+?)!nd_[a-z0-9_]+$')
+_NA_PIC_URL = re.compile(
+    r'^https?://sns-na-i[0-9]\.xhscdn\.com/(.+?)\?sign=[a-z0-9_&=]+$')
+PIC_URL = 'http://sns-img-hw.xhscdn.com/{}?imageView2/2/w/100000/format/jpg'
+
+TAG_TYPES = frozenset([
+    'topic', 'topic_page', 'location', 'location_page', 'custom',
+    'vendor', 'buyable_goods', 'goods', 'brand_page', 'brand',
+    'interact_pk', 'interact_vote', 'moment'])
+TOPIC_TYPES = frozenset([
+    'topic', 'topic_page', 'custom', 'location_page', 'location'])
+NOTE_KEYS = ('id', 'user_id', 'nickname', 'following', 'title',
+             'desc', 'time', 'last_update_time',
+             'ip_location', 'at_user', 'topics', 'url',
+             'comment_count', 'share_count', 'liked', 'liked_count',
+             'collected', 'collected_count', 'type', 'pic_ids', 'pics',
+             'video', 'video_md5')
+# merged into the note, their own xsec_token dropped
+_NESTED = ('user', 'share_info', 'interact_info')
+# consumed by parse_note, or dropped: live is the live stream info
+_PARSED = frozenset([
+    *_NESTED, 'illegal_info', 'live', 'avatar', 'un_share', 'note_id',
+    'followed', 'relation', 'tag_list', 'at_user_list', 'image_list',
+    'video', 'audio_info'])
+
+
 def parse_video_url(url: str) -> str:
+    if m := _PLAIN_URL.match(url):
+        scheme, host, path = m.groups()
+        if '?' in url and not url.endswith('?'):
+            assert _VIDEO_HOST.match(host), url
+        return f'{scheme}://sns-video-bd.xhscdn.com{path}'
     url = furl(url)
     if url.query:
-        pattern = r"^sns-video-[a-z0-9]{2}\.xhscdn\.com$"
-        assert re.match(pattern, url.host), url
+        assert _VIDEO_HOST.match(url.host), url
         url.query = None
     url.host = 'sns-video-bd.xhscdn.com'
     return str(url)
 
 
-def parse_note(note: dict) -> dict:
-    note = deepcopy(note)
-    for key in ['user',  'share_info', 'interact_info']:
-        value = note.pop(key)
-        value.pop('xsec_token', None)
-        assert note | value == value | note
-        note |= value
-    note.pop('illegal_info', None)
-    note.pop('live', None)  # 直播信息
-    note.pop('avatar')
-
-    for k in note:
-        if 'count' in k:
-            note[k] = normalize_count(note[k])
-
-    assert note.pop('un_share') is False
-    assert 'id' not in note
-    note['id'] = note.pop('note_id')
-    assert 'following' not in note
-    note['following'] = note.pop('followed')
-    if (relation := note.pop('relation')) in ['follows', 'both']:
-        assert note['following'] is True
-    else:
-        assert relation == 'none'
-        assert note['following'] is False
-    # relation = 'follows' if note['following'] else 'none'
-    # assert relation == note.pop('relation')
-    for k in ['time', 'last_update_time']:
-        note[k] = pendulum.from_timestamp(note[k]/1000, tz='local')
-
-    tags = {(tag['name'], tag['type']) for tag in note.pop('tag_list')}
-    tag_types = {'topic', 'topic_page', 'location', 'location_page', 'custom',
-                 'vendor', 'buyable_goods', 'goods', 'brand_page', 'brand',
-                 'interact_pk', 'interact_vote', 'moment'}
-    if extra_types := ({t for _, t in tags} - tag_types):
-        extra = {(n, t) for n, t in tags if t in extra_types}
+def _is_empty(value) -> bool:
+    return value is None or value == [] or value == '' or value == {}
+
+
+def parse_note(note: dict, strict: bool = False) -> dict:
+    """
+    flatten a note_card into the fields of Note
+
+    the payload is read, never modified, and walked once.
+
+    :param strict: also check the payload has no fields or shapes not
+        seen before; worth it for notes just fetched, cached ones were
+        checked when they were fetched
+    """
+    fields = {}
+
+    def put(key, value):
+        if 'count' in key:
+            value = normalize_count(value)
+        if isinstance(value, str):
+            value = value.replace('\x0b', ' ').strip()
+        fields[key] = value
+
+    for key, value in note.items():
+        if key not in _PARSED:
+            put(key, value)
+    merged = {}
+    for nested in _NESTED:
+        for key, value in note[nested].items():
+            if key == 'xsec_token':
+                continue
+            if key in note or key in merged:
+                if strict:
+                    assert note.get(key, merged.get(key)) == value, key
+                continue
+            merged[key] = value
+            if key not in _PARSED:
+                put(key, value)
+
+    def get(key):
+        return note[key] if key in note else merged[key]
+    following, relation = get('followed'), get('relation')
+    if strict:
+        get('avatar')
+        assert get('un_share') is False
+        for key in ['id', 'following', 'topics', 'at_user', 'pics',
+                    'pic_ids', 'audio']:
+            assert key not in fields, key
+        if relation in ['follows', 'both']:
+            assert following is True
+        else:
+            assert relation == 'none'
+            assert following is False
+    put('id', note['note_id'])
+    put('following', following)
+    for key in ['time', 'last_update_time']:
+        fields[key] = pendulum.from_timestamp(fields[key]/1000, tz='local')
+
+    tags = {(tag['name'], tag['type']) for tag in note['tag_list']}
+    if strict and (extra := {t for t in tags if t[1] not in TAG_TYPES}):
         console.log(
             f'{note["url"]} find extra tag types {extra}', style='error')
-    assert 'topics' not in note
-    note['topics'] = sorted({n for n, t in tags if t in (
-        'topic', 'topic_page', 'custom', 'location_page', 'location')})
-
-    assert 'at_user' not in note
-    at_user_list = []
-    for a in note.pop('at_user_list'):
-        if a not in at_user_list:
-            at_user_list.append(a)
-    at_user = {user['nickname']: user['user_id'] for user in at_user_list}
-    assert len(at_user) == len(at_user_list)
-    note['at_user'] = at_user
+    fields['topics'] = sorted({n for n, t in tags if t in TOPIC_TYPES})
+
+    at_user = {}
+    for a in note['at_user_list']:
+        if strict:
+            assert at_user.get(a['nickname'], a['user_id']) == a['user_id']
+        at_user[a['nickname']] = a['user_id']
+    fields['at_user'] = at_user
 
     pics, pic_ids = [], []
-    for image in note.pop('image_list'):
-        image: dict[str, str] = {k: v for k, v in image.items() if (v is False or v) and k not in [
-            'height', 'width']}
-        if info_list := image.pop('info_list', None):
-            assert all(len(i) == 2 for i in info_list)
-            info_list = {i['image_scene']: i['url'] for i in info_list}
-            assert (pic := image.pop('url_default')) == info_list.pop('WB_DFT')
-            assert (pic_pre := image.pop('url_pre')) == info_list.pop('WB_PRV')
-            assert not info_list
-            ptn = r'^https?://sns-webpic-qc\.xhscdn\.com/\d{12}/[a-f0-9]{32}/(.+?)!nd_[a-z0-9_]+$'
-            assert (pic_id := re.match(ptn, pic).group(
-                1)) == re.match(ptn, pic_pre).group(1)
-            pic = f'http://sns-img-hw.xhscdn.com/{pic_id}?imageView2/2/w/100000/format/jpg'
-        else:
-            ptn = r'^https?://sns-na-i[0-9]\.xhscdn\.com/(.+?)\?sign=[a-z0-9_&=]+$'
-            assert (pic_id := image.pop('file_id')) == re.match(
-                ptn, image.pop('url')).group(1)
-            pic = f'http://sns-img-hw.xhscdn.com/{pic_id}?imageView2/2/w/100000/format/jpg'
-        if image.pop('live_photo') is True:
-            stream = {k: v for k, v in image.pop('stream').items() if v}
-            assert len(stream) == 1
-            video_url = stream.pop('h264')[0]['master_url']
-            pic += ' ' + parse_video_url(video_url)
-        assert not image
+    for image in note['image_list']:
+        pic_id, pic = _parse_image(image, strict)
         pic_ids.append(pic_id)
         pics.append(pic)
-    assert 'pics' not in note
-    note['pics'] = pics
-    note['pic_ids'] = pic_ids
+    fields['pics'] = pics
+    fields['pic_ids'] = pic_ids
 
     if 'video' in note:
-        stream = note.pop('video').pop('media').pop('stream')
-        stream = {k: v for k, v in stream.items() if v}
-
-        h264 = stream.pop('h264', {})
-        d264 = {(d['height'], d['avg_bitrate']): d['master_url'] for d in h264}
-        assert len(h264) == len(d264)
-
-        h265 = stream.pop('h265', {})
-        d265 = {(d['height'], d['avg_bitrate']): d['master_url'] for d in h265}
-        assert len(h265) == len(d265)
-
-        assert not stream
-
+        put('video', _parse_video(note['video'], strict))
+    if audio := note.get('audio_info'):
+        fields['audio'] = audio
+
+    # keys of NOTE_KEYS first, the others as they came
+    parsed = {k: fields[k] for k in NOTE_KEYS
+              if k in fields and not _is_empty(fields[k])}
+    for k, v in fields.items():
+        if k not in parsed and not _is_empty(v):
+            parsed[k] = v
+    return parsed
+
+
+def _parse_image(image: dict, strict: bool) -> tuple[str, str]:
+    if info_list := image.get('info_list'):
+        pic = image['url_default']
+        pic_id = _WEBPIC_URL.match(pic).group(1)
+        if strict:
+            assert all(len(i) == 2 for i in info_list)
+            info = {i['image_scene']: i['url'] for i in info_list}
+            assert pic == info.pop('WB_DFT')
+            assert image['url_pre'] == info.pop('WB_PRV')
+            assert not info
+            assert pic_id == _WEBPIC_URL.match(image['url_pre']).group(1)
+            known = {'info_list', 'url_default', 'url_pre'}
+    else:
+        pic_id = image['file_id']
+        if strict:
+            assert pic_id == _NA_PIC_URL.match(image['url']).group(1)
+            known = {'info_list', 'file_id', 'url'}
+    pic = PIC_URL.format(pic_id)
+    if image['live_photo'] is True:
+        stream = {k: v for k, v in image['stream'].items() if v}
+        if strict:
+            assert len(stream) == 1
+            known.add('stream')
+        pic += ' ' + parse_video_url(stream['h264'][0]['master_url'])
+    if strict:
+        known |= {'height', 'width', 'live_photo'}
+        assert not {k for k, v in image.items()
+                    if (v is False or v) and k not in known}, image
+    return pic_id, pic
+
+
+def _parse_video(video: dict, strict: bool) -> str:
+    stream = {k: v for k, v in video['media']['stream'].items() if v}
+    d264 = {(d['height'], d['avg_bitrate']): d['master_url']
+            for d in stream.get('h264', ())}
+    d265 = {(d['height'], d['avg_bitrate']): d['master_url']
+            for d in stream.get('h265', ())}
+    if strict:
+        assert len(stream.get('h264', ())) == len(d264)
+        assert len(stream.get('h265', ())) == len(d265)
+        assert not stream.keys() - {'h264', 'h265'}
         if d264 and d265:
             assert max(d265)[0] >= max(d264)[0]
-        else:
-            d265 = d265 or d264
-        note['video'] = parse_video_url(d265[max(d265)])
-    if audio := note.pop('audio_info', None):
-        assert 'audio' not in note
-        note['audio'] = audio
-
-    for k in note:
-        if isinstance(note[k], str):
-            note[k] = note[k].replace('\x0b', ' ').strip()
-    note = {k: v for k, v in note.items() if v not in [None, [], '', {}]}
-
-    keys = ['id', 'user_id', 'nickname',   'following', 'title',
-            'desc', 'time', 'last_update_time',
-            'ip_location', 'at_user', 'topics', 'url',
-            'comment_count', 'share_count', 'liked', 'liked_count',
-            'collected', 'collected_count', 'type', 'pic_ids', 'pics',
-            'video', 'video_md5'
-            ]
-    note1 = {k: note[k] for k in keys if k in note}
-    note2 = {k: note[k] for k in note if k not in keys}
-    note_sorted = note1 | note2
-    assert note_sorted == note
-    return note_sorted
+    return parse_video_url((d265 or d264)[max(d265 or d264)])
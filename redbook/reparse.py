@@ -0,0 +1,163 @@
+"""
+Rebuild Note rows from the cached payloads after a parser change
+
+Cache rows of saved notes are read in keyset batches and parsed in a
+process pool, a few batches ahead of the main process, or in the main
+process itself with one worker. It diffs every
+parsed batch against the stored notes with one query and writes the
+changed rows with one bulk update per batch. Changes Note.upsert would
+refuse are reported as failures instead of written.
+"""
+import os
+import time
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator
+
+from redbook import console
+from redbook.model import Cache, Note, database
+from redbook.redbook import parse_note
+
+BATCH_SIZE = 1000
+PROGRESS = 10000  # notes between progress lines
+SAMPLES = 3  # changed values shown per field
+
+
+def parse_batch(infos: list[tuple[str, dict]]
+                ) -> list[tuple[str, dict | None, str]]:
+    """(note id, parsed note or None, error) per payload"""
+    parsed = []
+    for note_id, info in infos:
+        try:
+            parsed.append((note_id, parse_note(info), ''))
+        except Exception as e:
+            parsed.append((note_id, None, repr(e)))
+    return parsed
+
+
+def cache_batches(size: int = BATCH_SIZE
+                  ) -> Iterator[list[tuple[str, dict]]]:
+    """(id, payload) of the notes in Note, by id"""
+    last = ''
+    while True:
+        infos = list(Cache.select(Cache.id, Cache.note_info)
+                     .join(Note, on=(Note.id == Cache.id))
+                     .where(Cache.id > last)
+                     .order_by(Cache.id).limit(size).tuples())
+        if not infos:
+            return
+        last = infos[-1][0]
+        yield infos
+
+
+class Reparser:
+    def __init__(self, dry_run: bool = False) -> None:
+        self.dry_run = dry_run
+        self.rows = 0
+        self.changed = 0
+        self.failed: dict[str, str] = {}
+        self.fields = Counter()
+        self.unknown = Counter()
+        self.samples: dict[str, list] = {}
+
+    def __str__(self) -> str:
+        return (f'{self.rows} notes, {self.changed} changed, '
+                f'{len(self.failed)} failed')
+
+    def diff(self, parsed: list[tuple[str, dict | None, str]]
+             ) -> tuple[list[Note], list]:
+        """the notes whose stored fields differ and the fields that do"""
+        rows = {r['id']: r for r in Note.select().where(
+            Note.id.in_([i for i, _, _ in parsed])).dicts()}
+        changed, fields = [], set()
+        for note_id, note_dict, error in parsed:
+            self.rows += 1
+            if error:
+                self.failed[note_id] = error
+                continue
+            if not (row := rows.get(note_id)):
+                continue  # deleted since its payload was read
+            changes = {}
+            for key, value in note_dict.items():
+                if key == 'nickname':
+                    continue  # stored as username, taken from User
+                if not (field := Note._meta.combined.get(key)):
+                    self.unknown[key] += 1
+                    continue
+                if row[field.name] != value:
+                    changes[field.name] = value
+            if not changes:
+                continue
+            try:
+                for name in changes:
+                    Note.check_change(name, row, row | changes)
+            except AssertionError as e:
+                # upsert would refuse these changes too
+                self.failed[note_id] = f'{name}: {e!r}'
+                continue
+            for name, value in changes.items():
+                self.fields[name] += 1
+                samples = self.samples.setdefault(name, [])
+                if len(samples) < SAMPLES:
+                    samples.append((note_id, row[name], value))
+            fields.update(changes)
+            changed.append(Note(**(row | changes)))
+        self.changed += len(changed)
+        return changed, [Note._meta.fields[name] for name in fields]
+
+    def write(self, notes: list[Note], fields: list):
+        if self.dry_run or not notes:
+            return
+        with database.atomic():
+            Note.bulk_update(notes, fields, batch_size=200)
+
+    def run(self, workers: int = None, batch_size: int = BATCH_SIZE):
+        """
+        :param workers: parsing processes, one per cpu by default; 1
+            parses in this process, which the pool only beats when it gets
+            cores of its own
+        """
+        workers = workers or os.cpu_count()
+        start = time.perf_counter()
+        for parsed in self.parse(workers, batch_size):
+            self.write(*self.diff(parsed))
+            if self.rows % PROGRESS < batch_size:
+                elapsed = time.perf_counter() - start
+                console.log(f'{self} ({self.rows / elapsed:.0f} notes/s)')
+        self.report(time.perf_counter() - start)
+
+    @staticmethod
+    def parse(workers: int, batch_size: int
+              ) -> Iterator[list[tuple[str, dict | None, str]]]:
+        batches = cache_batches(batch_size)
+        if workers == 1:
+            yield from map(parse_batch, batches)
+            return
+        pending: list[Future] = []
+        with ProcessPoolExecutor(workers) as pool:
+            while True:
+                # keep the workers busy while this process diffs and writes
+                for infos in batches:
+                    pending.append(pool.submit(parse_batch, infos))
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    return
+                yield pending.pop(0).result()
+
+    def report(self, elapsed: float):
+        console.log(f'{self} in {elapsed:.1f}s '
+                    f'({self.rows / elapsed:.0f} notes/s)')
+        for name, count in self.fields.most_common():
+            console.log(f'{name}: {count} notes')
+            for note_id, old, new in self.samples[name]:
+                console.log(f'  {note_id}', style='dim')
+                console.log(f'  -{old}', style='red bold on dark_red')
+                console.log(f'  +{new}', style='green bold on dark_green')
+        for key, count in self.unknown.most_common():
+            console.log(f'{key}: not a Note field, in {count} notes',
+                        style='error')
+        for note_id, error in list(self.failed.items())[:10]:
+            console.log(f'{note_id}: {error}', style='error')
+        if self.dry_run:
+            console.log('dry run, nothing written')
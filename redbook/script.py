@@ -3,25 +3,29 @@ import itertools
 import random
 import select
 import sys
-import time
 from functools import wraps
 from pathlib import Path
 
 import pendulum
+from humanize import naturalsize
 from rich.prompt import Confirm, Prompt
-from toolkit.tool import asleep
-from typer import Typer
+from typer import Option, Typer
 
-from redbook import console
+from redbook import console, transport
+from redbook.download_scheduler import download_scheduler
+from redbook.fetch_schedule import FetchSchedule, VisitBudget
 from redbook.fetcher import fetcher
 from redbook.helper import (
     SAVE_PATH,
     download_file_pair,
     logsaver_decorator,
+    media_store,
     normalize_user_id,
     print_command, save_log
 )
-from redbook.model import Note, User, UserConfig
+from redbook.metadata import xmp_writer
+from redbook.model import Note, User, UserConfig, init_database
+from redbook.reparse import BATCH_SIZE, Reparser
 
 app = Typer(pretty_exceptions_show_locals=False)
 
@@ -30,13 +34,26 @@ def run_async(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         async def coro_wrapper():
-            return await func(*args, **kwargs)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                await transport.shutdown()
 
         return asyncio.run(coro_wrapper())
 
     return wrapper
 
 
+def use_database(func):
+    # tables are created on demand so --help and write_meta stay fast
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        init_database()
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 SAVE_LOG_INTERVAL = 24  # hours
 SAVE_LOG_FOR_COUNT = 200
 
@@ -55,6 +72,9 @@ class LogSaver:
             f'threshold: {SAVE_LOG_FOR_COUNT}')
         console.log(
             f'log hours: {log_hours}, threshold: {SAVE_LOG_INTERVAL}h')
+        console.log(f'signing: {fetcher.sign_stats}')
+        console.log(f'xmp writing: {xmp_writer}')
+        console.log(f'downloads: {download_scheduler}')
         if (log_hours > SAVE_LOG_INTERVAL or
                 fetch_count > SAVE_LOG_FOR_COUNT):
             console.log('Threshold reached, saving log automatically...')
@@ -69,6 +89,7 @@ class LogSaver:
 
 @app.command()
 @logsaver_decorator
+@use_database
 @run_async
 async def note():
     while note_id := Prompt.ask('请输入微博ID:smile:'):
@@ -81,52 +102,68 @@ async def note():
 
 @app.command()
 @logsaver_decorator
+@use_database
 @run_async
 async def user_loop(frequency: float = 4,
                     limit: int = 12,
-                    download_dir: Path = SAVE_PATH):
+                    download_dir: Path = SAVE_PATH,
+                    concurrency: int = Option(1, help=(
+                        'users fetched side by side, their downloads overlap '
+                        'the api waits of the others while all of them share '
+                        'one visit budget'))):
     console.log(f'current logined as: {await fetcher.login()}')
     logsaver = LogSaver('user_loop')
+    schedule = FetchSchedule()
+    budget = VisitBudget()
     while True:
         print_command()
         UserConfig.update_table()
-        post_count = ((time.time()-UserConfig.note_fetch_at.to_timestamp())
-                      / 3600 / UserConfig.post_cycle)
-        query = (
-            UserConfig.select()
-            .where(UserConfig.note_fetch)
-            .order_by(post_count.desc(), UserConfig.id)
-        )
-        if configs := query.where(UserConfig.note_fetch_at.is_null(True)):
+        if added := schedule.sync():
+            console.log(f'{added} users added to schedule '
+                        f'(total: {len(schedule)})')
+        configs = schedule.take(limit)
+        if not configs:
+            console.log('no user to fetch')
+        elif configs[0].note_fetch_at is None:
+            console.log(f'{len(configs)} new users found, fetching...')
+        elif (configs[-1].next_fetch_at is None or
+              configs[-1].next_fetch_at <= pendulum.now()):
             console.log(
-                f'total {configs.count()} new users found, fetching...')
-        elif (configs := query.where(post_count > 4)) and len(configs) >= 10:
-            console.log(
-                f' {len(configs)} users satisfy fetching conditions, '
-                'fetching users whose estimated new notes is most')
+                f'{len(configs)} users satisfy fetching conditions, '
+                'fetching users who became due first')
         else:
-            configs = query.order_by(UserConfig.note_fetch_at).limit(3)
             console.log(
                 'no user satisfy fetching conditions, '
-                'fetching users whose note_fetch_at is earliest.')
+                'fetching users whose fetch is due earliest.')
         current_visits = fetcher.visits
-        for i, config in enumerate(configs[:limit]):
-            console.log(
-                f'fetching {i+1}/{limit}: {config.username} '
-                f'(total: {len(configs)})')
-            visit = fetcher.visits
-            config = await UserConfig.from_id(user_id=config.user_id)
-            is_new = config.note_fetch_at is None
-            await config.fetch_note(download_dir)
-            logsaver.save_log(save_manually=is_new)
-            print_command()
-            if fetcher.visits > current_visits + 500:
-                console.log('break this loop since visits > 500')
-                break
-            visit = fetcher.visits - visit
-            sleep_time = visit * 30
-            console.log(f'sleep {sleep_time} for {visit} visits')
-            await asleep(sleep_time)
+        pending = iter(enumerate(configs))
+
+        async def fetch_users():
+            for i, config in pending:
+                if fetcher.visits > current_visits + 500:
+                    console.log('break this loop since visits > 500')
+                    return
+                await budget.wait()
+                console.log(
+                    f'fetching {i+1}/{len(configs)}: {config.username} '
+                    f'(scheduled: {len(schedule) + len(configs)})')
+                config = configs[i] = await UserConfig.from_id(
+                    user_id=config.user_id)
+                is_new = config.note_fetch_at is None
+                await config.fetch_note(download_dir)
+                logsaver.save_log(save_manually=is_new)
+                print_command()
+
+        tasks = [asyncio.create_task(fetch_users())
+                 for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for config in configs:
+                schedule.push(config)
         await fetcher.aclose()
         next_start_time = pendulum.now().add(hours=frequency*random.uniform(0.8, 1.2))
         console.rule(f'waiting for next fetching at {next_start_time:%Y-%m-%d %H:%M:%S}',
@@ -158,8 +195,21 @@ async def user_loop(frequency: float = 4,
                         )
 
 
+@app.command(help='Show the users user_loop fetches next')
+@use_database
+def schedule(limit: int = 20):
+    schedule = FetchSchedule()
+    schedule.sync()
+    console.log(f'{len(schedule)} users scheduled')
+    for next_fetch_at, config_id in schedule.peek(limit):
+        config = UserConfig.get_by_id(config_id)
+        due = f'{next_fetch_at:%y-%m-%d %H:%M}' if next_fetch_at else 'new'
+        console.log(f'{due:>14}  {config.username}')
+
+
 @app.command(help='Add user to database of users whom we want to fetch from')
 @logsaver_decorator
+@use_database
 @run_async
 async def user(download_dir: Path = SAVE_PATH):
     """Add user to database of users whom we want to fetch from"""
@@ -185,6 +235,7 @@ async def user(download_dir: Path = SAVE_PATH):
             if not Confirm.ask(
                     "current is caching, keep caching?", default=True):
                 config.note_fetch_at = None
+                config.next_fetch_at = None
                 config.is_caching = False
         config.save()
         console.log(f'用户{config.username}更新完成')
@@ -200,6 +251,13 @@ async def user(download_dir: Path = SAVE_PATH):
         console.log()
 
 
+@app.command(help='Rebuild notes from their cached payloads')
+@use_database
+def reparse(dry_run: bool = False, workers: int = None,
+            batch_size: int = BATCH_SIZE):
+    Reparser(dry_run=dry_run).run(workers, batch_size)
+
+
 @app.command()
 def write_meta(download_dir: Path = SAVE_PATH):
     from imgmeta.script import rename, write_meta
@@ -208,9 +266,20 @@ def write_meta(download_dir: Path = SAVE_PATH):
         if ori.exists():
             write_meta(ori)
             rename(ori, new_dir=True, root=ori.parent / (ori.stem + 'Pro'))
+    # write_meta rewrites the files, the blobs they were linked to are
+    # left behind in the store
+    clean_store()
+
+
+@app.command(help='Delete media store blobs no folder links to any more')
+def clean_store():
+    count, freed = media_store.gc()
+    console.log(f'{count} blobs deleted from media store, '
+                f'{naturalsize(freed)} freed')
 
 
 @app.command()
+@use_database
 def clean_database():
     for u in User:
         if (u.artist and u.artist[0].photos_num) or u.config:
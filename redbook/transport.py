@@ -0,0 +1,133 @@
+"""
+Shared connection pools for the api and CDN clients
+
+One transport per host family is reused by every AsyncClient, so refreshing
+cookies or re-creating a client keeps the warm (TLS) connections around.
+Transports are created on first use, commands that never go online don't
+pay for loading the trust store.
+"""
+import asyncio
+import importlib.util
+import socket
+import ssl
+import time
+from functools import cache
+
+import httpcore
+import httpx
+
+HTTP2 = importlib.util.find_spec('h2') is not None
+DNS_TTL = 300
+API_LIMITS = httpx.Limits(
+    max_connections=10, max_keepalive_connections=10, keepalive_expiry=300)
+CDN_LIMITS = httpx.Limits(
+    max_connections=40, max_keepalive_connections=20, keepalive_expiry=120)
+
+
+class CachingDNSBackend(httpcore.AsyncNetworkBackend):
+    """resolve each host once per ``ttl`` and count the new connections"""
+
+    def __init__(self, backend: httpcore.AsyncNetworkBackend,
+                 ttl: float = DNS_TTL) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.connects = 0
+        self._cache: dict[tuple[str, int], tuple[float, str]] = {}
+
+    async def resolve(self, host: str, port: int) -> str:
+        if (cached := self._cache.get((host, port))) and cached[0] > time.time():
+            return cached[1]
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM)
+        addr = infos[0][4][0]
+        self._cache[(host, port)] = (time.time() + self.ttl, addr)
+        return addr
+
+    async def connect_tcp(self, host, port, timeout=None,
+                          local_address=None, socket_options=None):
+        self.connects += 1
+        # tls still uses the origin host for SNI and certificate checks
+        addr = await self.resolve(host, port)
+        return await self.backend.connect_tcp(
+            addr, port, timeout=timeout,
+            local_address=local_address, socket_options=socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None,
+                                  socket_options=None):
+        return await self.backend.connect_unix_socket(
+            path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
+
+
+class PooledTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limits: httpx.Limits,
+                 verify: ssl.SSLContext | bool = True) -> None:
+        super().__init__(http2=HTTP2, limits=limits, verify=verify)
+        # httpx takes no network backend, so the pool it serves requests
+        # from is swapped for one built with httpcore's public constructor
+        if not isinstance(getattr(self, '_pool', None),
+                          httpcore.AsyncConnectionPool):
+            raise RuntimeError(
+                f'httpx {httpx.__version__} no longer keeps its connection '
+                'pool in AsyncHTTPTransport._pool, PooledTransport has to '
+                'be updated')
+        self.dns = CachingDNSBackend(httpcore.AnyIOBackend())
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(verify),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http2=HTTP2,
+            network_backend=self.dns)
+
+    @property
+    def connects(self) -> int:
+        return self.dns.connects
+
+    async def __aexit__(self, *args) -> None:
+        # shared by many clients: closing one client must not close the pool
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        await super().aclose()
+
+
+@cache
+def ssl_context() -> ssl.SSLContext:
+    """certificates from the system trust store"""
+    import truststore
+    return truststore.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+
+
+@cache
+def api_transport() -> PooledTransport:
+    return PooledTransport(API_LIMITS, verify=ssl_context())
+
+
+@cache
+def cdn_transport() -> PooledTransport:
+    return PooledTransport(CDN_LIMITS, verify=ssl_context())
+
+
+async def shutdown() -> None:
+    """close the pooled connections of the transports created so far"""
+    for transport in (api_transport, cdn_transport):
+        if transport.cache_info().currsize:
+            await transport().shutdown()
+    api_transport.cache_clear()
+    cdn_transport.cache_clear()
+    cdn_client.cache_clear()
+
+
+def api_client(cookies: dict = None) -> httpx.AsyncClient:
+    return httpx.AsyncClient(cookies=cookies, transport=api_transport())
+
+
+@cache
+def cdn_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=cdn_transport())
@@ -0,0 +1,30 @@
+"""
+database tests run on a scratch database named by REDBOOK_TEST_DATABASE,
+e.g. postgresql://localhost/redbook_test, and are skipped without it. The
+tables are created there and dropped afterwards.
+"""
+import os
+
+import pytest
+from playhouse.db_url import parse
+
+
+@pytest.fixture
+def database():
+    if not (url := os.environ.get('REDBOOK_TEST_DATABASE')):
+        pytest.skip('REDBOOK_TEST_DATABASE is not set')
+    from redbook import model
+    models = [model.User, model.UserConfig, model.Note, model.Artist,
+              model.Cache, model.Media]
+    db = model.database
+    saved = db.database, db.connect_params
+    params = parse(url)
+    db.close()
+    db.init(params.pop('database'), **params)
+    db.create_tables(models)
+    try:
+        yield db
+    finally:
+        db.drop_tables(models)
+        db.close()
+        db.init(saved[0], **saved[1])
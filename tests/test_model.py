@@ -0,0 +1,90 @@
+import asyncio
+
+import pendulum
+from peewee import fn
+
+from redbook.model import Cache, Note, User, UserConfig, note_url
+from redbook.redbook import parse_note
+
+USER_ID = '5b0d1a0b6eb13b5e00000000'
+
+
+def make_user(user_id: str = USER_ID) -> User:
+    User.insert(id=user_id, red_id=f'r{user_id}', username='someone',
+                nickname='nick', homepage='h', short_url='s', following=True,
+                gender=0, follows=0, fans=0, interaction=0, verified=False,
+                collection_public=False, avatar='a').execute()
+    return User.get_by_id(user_id)
+
+
+def payload(note_id: str, user: User, days_ago: int = 1) -> dict:
+    """a note_card as get_note returns it"""
+    time = pendulum.now().subtract(days=days_ago).int_timestamp * 1000
+    pic_id = f'1040g2sg31{note_id}'
+    return {
+        'note_id': note_id, 'type': 'normal', 'title': 'title',
+        'desc': 'desc', 'time': time, 'last_update_time': time,
+        'ip_location': 'somewhere', 'xsec_token': 'token',
+        'url': note_url(note_id, 'token'),
+        'user': {'user_id': user.id, 'nickname': user.nickname,
+                 'avatar': 'a', 'xsec_token': 'token'},
+        'interact_info': {
+            'liked': False, 'liked_count': '1', 'collected': False,
+            'collected_count': '0', 'comment_count': '0',
+            'share_count': '0', 'followed': True, 'relation': 'follows'},
+        'share_info': {'un_share': False},
+        'tag_list': [], 'at_user_list': [],
+        'image_list': [{
+            'file_id': pic_id, 'info_list': [], 'live_photo': False,
+            'url': f'https://sns-na-i6.xhscdn.com/{pic_id}?sign=abc',
+            'stream': {}, 'height': 1, 'width': 1}],
+    }
+
+
+def save_note(note_info: dict, user: User) -> Note:
+    """store a note and its cache as Note.from_id leaves them"""
+    cache = Cache.upsert(note_info)
+    note_dict = parse_note(note_info)
+    note_dict.pop('nickname')
+    note_dict['username'] = user.username
+    note_dict['added_at'] = note_dict['updated_at'] = cache.added_at
+    Note.insert(note_dict).execute()
+    return Note.get_by_id(note_info['note_id'])
+
+
+def count_queries(monkeypatch, database) -> list[str]:
+    queries = []
+    execute_sql = database.execute_sql
+
+    def counted(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(database, 'execute_sql', counted)
+    return queries
+
+
+def test_from_id_with_stored_rows_makes_no_query(database, monkeypatch):
+    user = make_user()
+    note = save_note(payload('68f88251000000000301d972', user), user)
+    cache = Cache.get_by_id(note.id)
+    queries = count_queries(monkeypatch, database)
+    got = asyncio.run(Note.from_id(note.id, user=user, stored=(note, cache)))
+    assert got is note
+    assert queries == []
+    asyncio.run(Note.from_id(note.id, user=user))
+    assert len(queries) == 2  # the note and its cache, nothing to write
+
+
+def test_new_config_counts_stored_notes(database, monkeypatch):
+    user = make_user()
+    for days_ago in (1, 3, 40):
+        note_id = f'68f882510000000003{days_ago:06d}'
+        save_note(payload(note_id, user, days_ago), user)
+
+    async def from_id(user_id, update=False):
+        return user
+    monkeypatch.setattr(User, 'from_id', from_id)
+    config = asyncio.run(UserConfig.from_id(user.id))
+    assert config.notes_count == 3
+    assert len(config.recent_posts) == 2
+    assert config.post_at == Note.select(fn.MAX(Note.time)).scalar()